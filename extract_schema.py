@@ -3,6 +3,35 @@ Script to extract schema information from SQLite database.
 """
 import sqlite3
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+def quote_identifier(name):
+    """
+    Quote an SQLite identifier so it can be safely embedded in a statement.
+    
+    Args:
+        name: Table or column name
+        
+    Returns:
+        The name wrapped in double quotes, with embedded quotes doubled
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+def split_index_sql(index_sql):
+    """
+    Split the concatenated index definitions of one table back into statements.
+    
+    Args:
+        index_sql: GROUP_CONCAT of rowid-prefixed index definitions, or None
+        
+    Returns:
+        Index statements in creation (rowid) order
+    """
+    if not index_sql:
+        return []
+    # GROUP_CONCAT order is unspecified, so restore the creation order here
+    entries = (entry.split('\x1f', 1) for entry in index_sql.split('\x1e'))
+    return [sql for _, sql in sorted((int(rowid), sql) for rowid, sql in entries)]
 
 def get_table_schema(db_path):
     """
@@ -23,44 +52,57 @@ def get_table_schema(db_path):
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
         
-        # Get list of all tables
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        tables = cursor.fetchall()
+        # Read-only extraction inside a single transaction for a consistent snapshot
+        cursor.execute("PRAGMA query_only=1")
+        cursor.execute("PRAGMA cache_size=-64000")
         
-        schemas = {}
-        for table in tables:
-            table_name = table[0]
-            
-            # Get CREATE TABLE statement
-            cursor.execute(f"SELECT sql FROM sqlite_master WHERE type='table' AND name='{table_name}';")
-            create_stmt = cursor.fetchone()[0]
+        with conn:
+            cursor.execute("BEGIN")
             
-            # Get indices for this table
-            cursor.execute(f"SELECT sql FROM sqlite_master WHERE type='index' AND tbl_name='{table_name}';")
-            indices = cursor.fetchall()
-            index_stmts = [idx[0] for idx in indices if idx[0] is not None]
+            # One row per table: its definition plus all of its index definitions, each
+            # prefixed with its rowid and concatenated with separators that cannot occur in DDL.
+            # SQLite's internal tables are skipped; they are not part of the documented schema.
+            cursor.execute("""
+                SELECT tbl_name,
+                       MAX(CASE WHEN type = 'table' THEN sql END),
+                       GROUP_CONCAT(CASE WHEN type = 'index' THEN rowid || char(31) || sql END, char(30))
+                FROM sqlite_master
+                WHERE type IN ('table', 'index') AND sql IS NOT NULL
+                  AND substr(tbl_name, 1, 7) != 'sqlite_'
+                GROUP BY tbl_name
+                ORDER BY tbl_name
+            """)
+            definitions = cursor.fetchall()
             
-            # Get sample data (first few rows)
-            try:
-                cursor.execute(f"SELECT * FROM {table_name} LIMIT 3;")
-                columns = [description[0] for description in cursor.description]
-                rows = cursor.fetchall()
-                sample_data = []
-                if rows:
-                    sample_data.append("-- Sample data:")
-                    sample_data.append(f"-- |{'|'.join(columns)}|")
-                    sample_data.append(f"-- |{'--|' * len(columns)}")
-                    for row in rows:
-                        formatted_row = [str(cell) if cell is not None else "NULL" for cell in row]
-                        sample_data.append(f"-- |{'|'.join(formatted_row)}|")
-            except sqlite3.Error as e:
-                sample_data = [f"-- Error getting sample data: {str(e)}"]
+            schemas = {}
+            for table_name, create_stmt, index_sql in definitions:
+                index_stmts = split_index_sql(index_sql)
+                
+                # Indices whose table definition is missing cannot be documented
+                if create_stmt is None:
+                    continue
+                
+                # Get sample data (first few rows)
+                try:
+                    cursor.execute(f"SELECT * FROM {quote_identifier(table_name)} LIMIT 3;")
+                    columns = [description[0] for description in cursor.description]
+                    rows = cursor.fetchall()
+                    sample_data = []
+                    if rows:
+                        sample_data.append("-- Sample data:")
+                        sample_data.append(f"-- |{'|'.join(columns)}|")
+                        sample_data.append(f"-- |{'--|' * len(columns)}")
+                        for row in rows:
+                            formatted_row = [str(cell) if cell is not None else "NULL" for cell in row]
+                            sample_data.append(f"-- |{'|'.join(formatted_row)}|")
+                except sqlite3.Error as e:
+                    sample_data = [f"-- Error getting sample data: {str(e)}"]
             
-            schemas[table_name] = {
-                'create_stmt': create_stmt,
-                'indices': index_stmts,
-                'sample_data': sample_data
-            }
+                schemas[table_name] = {
+                    'create_stmt': create_stmt,
+                    'indices': index_stmts,
+                    'sample_data': sample_data
+                }
         
         return schemas
     
@@ -72,6 +114,34 @@ def get_table_schema(db_path):
         if conn:
             conn.close()
 
+def _write_schema_file(table_name, schema_info, output_dir):
+    """
+    Write the SQL file for a single table.
+    
+    Args:
+        table_name: Name of the table
+        schema_info: Schema information for the table
+        output_dir: Directory to write the SQL file to
+        
+    Returns:
+        Path of the written file
+    """
+    file_path = os.path.join(output_dir, f"{table_name}.sql")
+    
+    # Assemble the whole file in memory and write it with a single call
+    parts = [
+        f"-- {table_name} definition\n\n",
+        f"{schema_info['create_stmt']};\n\n",
+        *(f"{index_stmt};\n" for index_stmt in schema_info['indices']),
+        "\n\n" if schema_info['indices'] else "",
+        *(f"{data_line}\n" for data_line in schema_info['sample_data'])
+    ]
+    
+    with open(file_path, 'w') as f:
+        f.write(''.join(parts))
+    
+    return file_path
+
 def write_schema_files(schemas, output_dir):
     """
     Write schema information to SQL files.
@@ -82,23 +152,14 @@ def write_schema_files(schemas, output_dir):
     """
     os.makedirs(output_dir, exist_ok=True)
     
-    for table_name, schema_info in schemas.items():
-        file_path = os.path.join(output_dir, f"{table_name}.sql")
-        
-        with open(file_path, 'w') as f:
-            f.write(f"-- {table_name} definition\n\n")
-            f.write(f"{schema_info['create_stmt']};\n\n")
-            
-            for index_stmt in schema_info['indices']:
-                f.write(f"{index_stmt};\n")
-            
-            if schema_info['indices']:
-                f.write("\n\n")
-            
-            for data_line in schema_info['sample_data']:
-                f.write(f"{data_line}\n")
-        
-        print(f"Created schema file: {file_path}")
+    # Files are independent, so write them concurrently; print from this thread only
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        file_paths = executor.map(
+            lambda item: _write_schema_file(item[0], item[1], output_dir),
+            schemas.items()
+        )
+        for file_path in file_paths:
+            print(f"Created schema file: {file_path}")
 
 if __name__ == "__main__":
     db_path = "meta_results/flood_risk_shapefiles.db"
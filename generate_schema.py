@@ -14,12 +14,63 @@ Example:
 
 import sqlite3
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 import sys
 import argparse
 from pathlib import Path
 from typing import Dict, List, Tuple, Optional, Any
 
 
+def quote_identifier(name: str) -> str:
+    """
+    Quote an SQLite identifier so it can be safely embedded in a statement.
+    
+    Args:
+        name: Table or column name
+        
+    Returns:
+        The name wrapped in double quotes, with embedded quotes doubled
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+# Comments, string literals and quoted identifiers, which may contain any keyword
+_DDL_NON_KEYWORDS = re.compile(r"""--[^\n]*|/\*.*?(?:\*/|$)|'(?:[^']|'')*'|"(?:[^"]|"")*"|`(?:[^`]|``)*`|\[[^\]]*\]""",
+                               re.DOTALL)
+
+
+def uses_autoincrement(create_stmt: str) -> bool:
+    """
+    Check whether a CREATE TABLE statement declares AUTOINCREMENT.
+    
+    Args:
+        create_stmt: Table definition from sqlite_master
+        
+    Returns:
+        True if the keyword appears outside comments, literals and quoted names
+    """
+    stripped = _DDL_NON_KEYWORDS.sub(' ', create_stmt)
+    return re.search(r'\bAUTOINCREMENT\b', stripped, re.IGNORECASE) is not None
+
+
+def split_index_sql(index_sql: Optional[str]) -> List[str]:
+    """
+    Split the concatenated index definitions of one table back into statements.
+    
+    Args:
+        index_sql: GROUP_CONCAT of rowid-prefixed index definitions, or None
+        
+    Returns:
+        Index statements in creation (rowid) order
+    """
+    if not index_sql:
+        return []
+    # GROUP_CONCAT order is unspecified, so restore the creation order here
+    entries = (entry.split('\x1f', 1) for entry in index_sql.split('\x1e'))
+    return [sql for _, sql in sorted((int(rowid), sql) for rowid, sql in entries)]
+
+
 def get_table_schema(db_path: str) -> Dict[str, Dict[str, Any]]:
     """
     Extract schema information from SQLite database.
@@ -39,48 +90,77 @@ def get_table_schema(db_path: str) -> Dict[str, Dict[str, Any]]:
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
         
-        # Get list of all tables
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name;")
-        tables = cursor.fetchall()
+        # Read-only extraction inside a single transaction for a consistent snapshot
+        cursor.execute("PRAGMA query_only=1")
+        cursor.execute("PRAGMA cache_size=-64000")
         
-        schemas = {}
-        for table in tables:
-            table_name = table[0]
-            
-            # Skip SQLite internal tables
-            if table_name.startswith('sqlite_'):
-                continue
-            
-            # Get CREATE TABLE statement
-            cursor.execute(f"SELECT sql FROM sqlite_master WHERE type='table' AND name='{table_name}';")
-            create_stmt = cursor.fetchone()[0]
+        with conn:
+            cursor.execute("BEGIN")
             
-            # Get indices for this table
-            cursor.execute(f"SELECT sql FROM sqlite_master WHERE type='index' AND tbl_name='{table_name}' AND sql IS NOT NULL;")
-            indices = cursor.fetchall()
-            index_stmts = [idx[0] for idx in indices if idx[0] is not None]
+            # One row per table: its definition plus all of its index definitions, each
+            # prefixed with its rowid and concatenated with separators that cannot occur in DDL.
+            # SQLite's internal tables are skipped; they are not part of the documented schema.
+            cursor.execute("""
+                SELECT tbl_name,
+                       MAX(CASE WHEN type = 'table' THEN sql END),
+                       GROUP_CONCAT(CASE WHEN type = 'index' THEN rowid || char(31) || sql END, char(30))
+                FROM sqlite_master
+                WHERE type IN ('table', 'index') AND sql IS NOT NULL
+                  AND substr(tbl_name, 1, 7) != 'sqlite_'
+                GROUP BY tbl_name
+                ORDER BY tbl_name
+            """)
+            definitions = cursor.fetchall()
             
-            # Get sample data (first few rows)
-            try:
-                cursor.execute(f"SELECT * FROM {table_name} LIMIT 3;")
-                columns = [description[0] for description in cursor.description]
-                rows = cursor.fetchall()
-                sample_data = []
-                if rows:
-                    sample_data.append("-- Sample data:")
-                    sample_data.append(f"-- |{'|'.join(columns)}|")
-                    sample_data.append(f"-- |{'--|' * len(columns)}")
-                    for row in rows:
-                        formatted_row = [str(cell) if cell is not None else "NULL" for cell in row]
-                        sample_data.append(f"-- |{'|'.join(formatted_row)}|")
-            except sqlite3.Error as e:
-                sample_data = [f"-- Error getting sample data: {str(e)}"]
+            schemas = {}
+            for table_name, create_stmt, index_sql in definitions:
+                index_stmts = split_index_sql(index_sql)
+                
+                # Indices whose table definition is missing cannot be documented
+                if create_stmt is None:
+                    continue
+                
+                # Let SQLite's own parser describe columns and foreign keys
+                quoted_name = quote_identifier(table_name)
+                cursor.execute(f"PRAGMA table_info({quoted_name})")
+                columns_info = cursor.fetchall()
+                cursor.execute(f"PRAGMA foreign_key_list({quoted_name})")
+                foreign_keys = cursor.fetchall()
+                
+                # Columns carrying a UNIQUE constraint of their own; rows are (seq, name, unique, origin, partial)
+                unique_columns = set()
+                cursor.execute(f"PRAGMA index_list({quoted_name})")
+                for _, index_name, _, origin, _ in cursor.fetchall():
+                    if origin == 'u':
+                        cursor.execute(f"PRAGMA index_info({quote_identifier(index_name)})")
+                        index_columns = cursor.fetchall()
+                        if len(index_columns) == 1:
+                            unique_columns.add(index_columns[0][2])
+                
+                # Get sample data (first few rows)
+                try:
+                    cursor.execute(f"SELECT * FROM {quote_identifier(table_name)} LIMIT 3;")
+                    columns = [description[0] for description in cursor.description]
+                    rows = cursor.fetchall()
+                    sample_data = []
+                    if rows:
+                        sample_data.append("-- Sample data:")
+                        sample_data.append(f"-- |{'|'.join(columns)}|")
+                        sample_data.append(f"-- |{'--|' * len(columns)}")
+                        for row in rows:
+                            formatted_row = [str(cell) if cell is not None else "NULL" for cell in row]
+                            sample_data.append(f"-- |{'|'.join(formatted_row)}|")
+                except sqlite3.Error as e:
+                    sample_data = [f"-- Error getting sample data: {str(e)}"]
             
-            schemas[table_name] = {
-                'create_stmt': create_stmt,
-                'indices': index_stmts,
-                'sample_data': sample_data
-            }
+                schemas[table_name] = {
+                    'create_stmt': create_stmt,
+                    'indices': index_stmts,
+                    'sample_data': sample_data,
+                    'columns': columns_info,
+                    'unique_columns': unique_columns,
+                    'foreign_keys': foreign_keys
+                }
         
         return schemas
     
@@ -93,6 +173,35 @@ def get_table_schema(db_path: str) -> Dict[str, Dict[str, Any]]:
             conn.close()
 
 
+def _write_schema_file(table_name: str, schema_info: Dict[str, Any], output_dir: str) -> str:
+    """
+    Write the SQL file for a single table.
+    
+    Args:
+        table_name: Name of the table
+        schema_info: Schema information for the table
+        output_dir: Directory to write the SQL file to
+        
+    Returns:
+        Path of the written file
+    """
+    file_path = os.path.join(output_dir, f"{table_name}.sql")
+    
+    # Assemble the whole file in memory and write it with a single call
+    parts = [
+        f"-- {table_name} definition\n\n",
+        f"{schema_info['create_stmt']};\n\n",
+        *(f"{index_stmt};\n" for index_stmt in schema_info['indices']),
+        "\n\n" if schema_info['indices'] else "",
+        *(f"{data_line}\n" for data_line in schema_info['sample_data'])
+    ]
+    
+    with open(file_path, 'w') as f:
+        f.write(''.join(parts))
+    
+    return file_path
+
+
 def write_schema_files(schemas: Dict[str, Dict[str, Any]], output_dir: str) -> None:
     """
     Write schema information to SQL files.
@@ -103,23 +212,14 @@ def write_schema_files(schemas: Dict[str, Dict[str, Any]], output_dir: str) -> N
     """
     os.makedirs(output_dir, exist_ok=True)
     
-    for table_name, schema_info in schemas.items():
-        file_path = os.path.join(output_dir, f"{table_name}.sql")
-        
-        with open(file_path, 'w') as f:
-            f.write(f"-- {table_name} definition\n\n")
-            f.write(f"{schema_info['create_stmt']};\n\n")
-            
-            for index_stmt in schema_info['indices']:
-                f.write(f"{index_stmt};\n")
-            
-            if schema_info['indices']:
-                f.write("\n\n")
-            
-            for data_line in schema_info['sample_data']:
-                f.write(f"{data_line}\n")
-        
-        print(f"Created schema file: {file_path}")
+    # Files are independent, so write them concurrently; print from this thread only
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        file_paths = executor.map(
+            lambda item: _write_schema_file(item[0], item[1], output_dir),
+            schemas.items()
+        )
+        for file_path in file_paths:
+            print(f"Created schema file: {file_path}")
 
 
 def generate_markdown_summary(schemas: Dict[str, Dict[str, Any]], db_path: str, output_dir: str) -> None:
@@ -134,110 +234,76 @@ def generate_markdown_summary(schemas: Dict[str, Dict[str, Any]], db_path: str,
     db_name = os.path.basename(db_path)
     file_path = os.path.join(output_dir, "database_schema.md")
     
-    with open(file_path, 'w') as f:
-        f.write(f"# Database Schema: {db_name}\n\n")
-        f.write("## Tables\n\n")
+    # Collect all markdown fragments and write the file with a single call
+    output = []
+    output.append(f"# Database Schema: {db_name}\n\n")
+    output.append("## Tables\n\n")
+    
+    for table_name in sorted(schemas.keys()):
+        output.append(f"### {table_name}\n\n")
+        output.append(f"[SQL Definition](./{table_name}.sql)\n\n")
         
-        for table_name in sorted(schemas.keys()):
-            f.write(f"### {table_name}\n\n")
-            f.write(f"[SQL Definition](./{table_name}.sql)\n\n")
-            
-            # Extract column information from CREATE TABLE statement
-            create_stmt = schemas[table_name]['create_stmt']
-            # Simple parsing to extract column definitions
-            try:
-                columns_part = create_stmt.split('(', 1)[1].rsplit(')', 1)[0].strip()
-                # Handle multi-line definitions and remove trailing commas
-                columns = []
-                current_column = ""
-                paren_count = 0
-                
-                for char in columns_part:
-                    if char == '(' and not current_column.endswith("'") and not current_column.endswith('"'):
-                        paren_count += 1
-                    elif char == ')' and not current_column.endswith("'") and not current_column.endswith('"'):
-                        paren_count -= 1
-                    
-                    current_column += char
-                    
-                    if char == ',' and paren_count == 0:
-                        columns.append(current_column[:-1].strip())
-                        current_column = ""
-                
-                if current_column.strip():
-                    columns.append(current_column.strip())
-                
-                # Filter out constraints that aren't column definitions
-                columns = [col for col in columns if not col.upper().startswith(('PRIMARY KEY', 'FOREIGN KEY', 'UNIQUE', 'CHECK', 'CONSTRAINT'))]
-                
-                f.write("#### Columns\n\n")
-                f.write("| Column | Type | Constraints |\n")
-                f.write("|--------|------|-------------|\n")
-                
-                for col in columns:
-                    parts = col.split(' ', 1)
-                    column_name = parts[0].strip()
-                    if len(parts) > 1:
-                        rest = parts[1].strip()
-                        # Try to separate type from constraints
-                        type_parts = rest.split(' ', 1)
-                        col_type = type_parts[0].strip()
-                        constraints = type_parts[1].strip() if len(type_parts) > 1 else ""
-                        f.write(f"| {column_name} | {col_type} | {constraints} |\n")
-                    else:
-                        f.write(f"| {column_name} | | |\n")
-                
-                f.write("\n")
-            except Exception as e:
-                f.write(f"Error parsing column information: {str(e)}\n\n")
-            
-            # List indices
-            if schemas[table_name]['indices']:
-                f.write("#### Indices\n\n")
-                for idx in schemas[table_name]['indices']:
-                    f.write(f"```sql\n{idx};\n```\n\n")
+        # Columns come from PRAGMA table_info: (cid, name, type, notnull, dflt_value, pk)
+        create_stmt = schemas[table_name]['create_stmt']
+        output.append("#### Columns\n\n")
+        output.append("| Column | Type | Constraints |\n")
+        output.append("|--------|------|-------------|\n")
         
-        f.write("## Relationships\n\n")
-        f.write("Foreign key relationships between tables:\n\n")
+        # SQLite only accepts AUTOINCREMENT on a single-column INTEGER PRIMARY KEY
+        columns_info = schemas[table_name]['columns']
+        pk_columns = [column for column in columns_info if column[5]]
+        autoincrement_column = None
+        if (len(pk_columns) == 1 and pk_columns[0][2].upper() == 'INTEGER'
+                and uses_autoincrement(create_stmt)):
+            autoincrement_column = pk_columns[0][1]
         
-        for table_name, schema_info in schemas.items():
-            create_stmt = schema_info['create_stmt']
-            # Extract foreign key constraints
-            if "FOREIGN KEY" in create_stmt.upper():
-                f.write(f"### {table_name} relationships\n\n")
-                
-                # Simple parsing to extract foreign key definitions
-                try:
-                    parts = create_stmt.split('FOREIGN KEY')
-                    for i in range(1, len(parts)):
-                        fk_def = parts[i].strip()
-                        if fk_def.startswith('('):
-                            # Extract the constraint
-                            paren_count = 1
-                            j = 1
-                            while j < len(fk_def) and paren_count > 0:
-                                if fk_def[j] == '(':
-                                    paren_count += 1
-                                elif fk_def[j] == ')':
-                                    paren_count -= 1
-                                j += 1
-                            
-                            local_col = fk_def[1:j-1].strip()
-                            
-                            # Extract the reference
-                            ref_part = fk_def[j:].strip()
-                            if ref_part.upper().startswith('REFERENCES'):
-                                ref_part = ref_part[10:].strip()  # Remove "REFERENCES"
-                                ref_table = ref_part.split('(')[0].strip()
-                                ref_col = ref_part.split('(')[1].split(')')[0].strip()
-                                
-                                f.write(f"- `{local_col}` → `{ref_table}({ref_col})`\n")
-                except Exception as e:
-                    f.write(f"Error parsing foreign key relationships: {str(e)}\n\n")
-                
-                f.write("\n")
+        for _, column_name, col_type, notnull, default_value, pk in columns_info:
+            constraints = []
+            if pk:
+                constraints.append("PRIMARY KEY")
+                if column_name == autoincrement_column:
+                    constraints.append("AUTOINCREMENT")
+            if notnull:
+                constraints.append("NOT NULL")
+            if column_name in schemas[table_name]['unique_columns']:
+                constraints.append("UNIQUE")
+            if default_value is not None:
+                constraints.append(f"DEFAULT {default_value}")
+            output.append(f"| {column_name} | {col_type} | {' '.join(constraints)} |\n")
+        
+        output.append("\n")
         
-        print(f"Created markdown summary: {file_path}")
+        # List indices
+        if schemas[table_name]['indices']:
+            output.append("#### Indices\n\n")
+            for idx in schemas[table_name]['indices']:
+                output.append(f"```sql\n{idx};\n```\n\n")
+    
+    output.append("## Relationships\n\n")
+    output.append("Foreign key relationships between tables:\n\n")
+    
+    for table_name, schema_info in schemas.items():
+        # Rows from PRAGMA foreign_key_list: (id, seq, table, from, to, ...)
+        if schema_info['foreign_keys']:
+            output.append(f"### {table_name} relationships\n\n")
+            
+            # SQLite numbers constraints in reverse declaration order
+            constraints = {}
+            for fk_id, _, ref_table, local_col, ref_col, *_ in sorted(
+                    schema_info['foreign_keys'], key=lambda fk: (-fk[0], fk[1])):
+                constraint = constraints.setdefault(fk_id, (ref_table, [], []))
+                constraint[1].append(local_col)
+                constraint[2].append(ref_col or "")
+            
+            for ref_table, local_cols, ref_cols in constraints.values():
+                output.append(f"- `{', '.join(local_cols)}` → `{ref_table}({', '.join(ref_cols)})`\n")
+            
+            output.append("\n")
+    
+    with open(file_path, 'w') as f:
+        f.write(''.join(output))
+    
+    print(f"Created markdown summary: {file_path}")
 
 
 def main():
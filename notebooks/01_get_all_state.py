@@ -1,6 +1,34 @@
 import json
-import re
 import os
+from html.parser import HTMLParser
+from operator import itemgetter
+
+# Size of the pieces the HTML file is fed to the parser in
+READ_CHUNK_SIZE = 1 << 16
+
+class OptionParser(HTMLParser):
+    """
+    Collect (value, text) pairs from <option> elements, with entities decoded
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.options = []
+        self.current_value = None
+        self.current_text = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'option':
+            self.current_value = dict(attrs).get('value') or ''
+            self.current_text = []
+
+    def handle_data(self, data):
+        if self.current_value is not None:
+            self.current_text.append(data)
+
+    def handle_endtag(self, tag):
+        if tag == 'option' and self.current_value is not None:
+            self.options.append((self.current_value, ''.join(self.current_text).strip()))
+            self.current_value = None
 
 def extract_states_from_html():
     """
@@ -9,19 +37,17 @@ def extract_states_from_html():
     # Read the HTML file
     html_file_path = os.path.join('..', 'meta', 'state.html')
     
-    with open(html_file_path, 'r', encoding='utf-8') as file:
-        html_content = file.read()
-    
-    # Use regex to find all option elements with value and text
-    option_pattern = r'<option[^>]*value="([^"]*)"[^>]*>([^<]*)</option>'
-    matches = re.findall(option_pattern, html_content)
-    
     # Extract states data (skip the first "-- Select --" option)
     states_data = []
     
-    for value, text in matches:
-        text = text.strip()
-        
+    # Feed the file to the parser in chunks instead of reading it into one string
+    parser = OptionParser()
+    with open(html_file_path, 'r', encoding='utf-8') as file:
+        for chunk in iter(lambda: file.read(READ_CHUNK_SIZE), ''):
+            parser.feed(chunk)
+    parser.close()
+    
+    for value, text in parser.options:
         # Skip the placeholder option
         if value and value != 'none':
             states_data.append({
@@ -30,7 +56,7 @@ def extract_states_from_html():
             })
     
     # Sort by value for better organization
-    states_data.sort(key=lambda x: x['value'])
+    states_data.sort(key=itemgetter('value'))
     
     # Create the final JSON structure
     result = {
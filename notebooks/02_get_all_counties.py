@@ -1,9 +1,36 @@
 import json
+import logging
 import requests
+import sqlite3
 import time
 import os
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 from typing import Dict, List, Any
 
+import fetch_cache
+from fema_utils import (REQUEST_TIMEOUT, FetchError, RateLimiter, create_session, enable_wal, fetch_with_requeue,
+                        write_json_file)
+
+# Number of states fetched concurrently
+MAX_WORKERS = 8
+
+# Most county lookups started per second, however many workers are running
+REQUESTS_PER_SECOND = 8
+
+# County lookups are idempotent GETs, so they are safe to retry on 429 and 5xx responses
+SESSION = create_session(
+    {'Accept-Encoding': 'gzip, deflate', 'User-Agent': 'cityplanner-fema/1.0'},
+    pool_size=MAX_WORKERS,
+    retries=5,
+    retry_statuses=(429, 500, 502, 503, 504),
+    retry_methods=('GET',)
+)
+
+# SQLite copy of the fetched counties, shared with the communities script
+METADATA_DB_PATH = os.path.join('..', 'meta_results', 'fema_metadata.db')
+DB_BATCH_SIZE = 1000
+
 def load_states_data() -> Dict[str, Any]:
     """
     Load states data from the JSON file
@@ -12,29 +39,34 @@ def load_states_data() -> Dict[str, Any]:
     with open(states_file, 'r', encoding='utf-8') as file:
         return json.load(file)
 
-def fetch_counties_for_state(state_value: str, state_name: str) -> List[Dict[str, str]]:
+def fetch_counties_for_state(state_value: str, state_name: str,
+                             rate_limiter: RateLimiter = None) -> List[Dict[str, str]]:
     """
     Fetch counties for a specific state from FEMA API
     """
     url = f"https://msc.fema.gov/portal/advanceSearch?getCounty={state_value}"
     
-    try:
+    def request_counties():
+        if rate_limiter:
+            rate_limiter.acquire()
         print(f"Fetching counties for {state_name} (value: {state_value})...")
-        response = requests.get(url, timeout=30)
+        response = SESSION.get(url, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
         
         # Parse JSON response
-        counties_data = response.json()
+        return response.json()
+    
+    try:
+        # Served from the checkpoint store when a previous run already fetched it
+        counties_data = fetch_cache.get_or_fetch(f"county:{state_value}", request_counties)
         
         print(f"  Found {len(counties_data)} counties for {state_name}")
         return counties_data
         
     except requests.exceptions.RequestException as e:
-        print(f"  Error fetching data for {state_name}: {e}")
-        return []
+        raise FetchError(f"Error fetching data for {state_name}: {e}") from e
     except json.JSONDecodeError as e:
-        print(f"  Error parsing JSON for {state_name}: {e}")
-        return []
+        raise FetchError(f"Error parsing JSON for {state_name}: {e}") from e
 
 def fetch_all_counties():
     """
@@ -53,46 +85,86 @@ def fetch_all_counties():
         "states": {}
     }
     
-    total_counties = 0
+    rate_limiter = RateLimiter(REQUESTS_PER_SECOND)
+    counties_by_state = {}
+    failed_states = 0
+    
+    # Fetch all states concurrently; the rate limiter keeps us polite to the API
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        def submit(state):
+            return executor.submit(fetch_counties_for_state, state["value"], state["text"], rate_limiter)
+        
+        for state, counties in fetch_with_requeue(submit, states_data["states"]):
+            # Not cached, so a state given up on is fetched again by the next run
+            if counties is None:
+                failed_states += 1
+                counties = []
+            counties_by_state[state["value"]] = counties
     
-    # Process each state
+    # Store in result structure, keeping the original state order
     for state in states_data["states"]:
         state_value = state["value"]
-        state_name = state["text"]
-        
-        # Fetch counties for this state
-        counties = fetch_counties_for_state(state_value, state_name)
-        
-        # Store in result structure
+        counties = counties_by_state[state_value]
         all_counties["states"][state_value] = {
-            "state_name": state_name,
+            "state_name": state["text"],
             "state_code": state_value,
             "county_count": len(counties),
             "counties": counties
         }
-        
-        total_counties += len(counties)
-        
-        # Add small delay to be respectful to the API
-        time.sleep(0.5)
+    
+    total_counties = sum(state_data["county_count"] for state_data in all_counties["states"].values())
     
     # Update total count
     all_counties["metadata"]["total_counties"] = total_counties
     
     # Save to JSON file
     output_file = os.path.join('..', 'meta_results', 'all_counties_data.json')
-    with open(output_file, 'w', encoding='utf-8') as json_file:
-        json.dump(all_counties, json_file, indent=2, ensure_ascii=False)
+    write_json_file(all_counties, output_file)
     
     print(f"\nSuccessfully fetched county data for all states!")
     print(f"Total counties: {total_counties}")
+    if failed_states:
+        print(f"Failed states: {failed_states} (not cached; rerun to fetch them)")
     print(f"Data saved to: {output_file}")
     
+    save_counties_to_database(all_counties)
+    
     # Create summary report
     create_summary_report(all_counties)
     
     return all_counties
 
+def save_counties_to_database(all_counties: Dict[str, Any], db_path: str = METADATA_DB_PATH):
+    """
+    Store the fetched counties in SQLite, inserting in batches of DB_BATCH_SIZE rows
+    """
+    # Transactions are managed explicitly so each batch commits exactly once
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        enable_wal(conn)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS counties (
+                state_code TEXT NOT NULL,
+                county_code TEXT NOT NULL,
+                county_name TEXT,
+                PRIMARY KEY (state_code, county_code)
+            )
+        ''')
+        
+        rows = [
+            (state_code, county["value"], county["label"])
+            for state_code, state_data in all_counties["states"].items()
+            for county in state_data["counties"]
+        ]
+        for start in range(0, len(rows), DB_BATCH_SIZE):
+            conn.execute('BEGIN')
+            conn.executemany('INSERT OR IGNORE INTO counties VALUES (?, ?, ?)', rows[start:start + DB_BATCH_SIZE])
+            conn.execute('COMMIT')
+    finally:
+        conn.close()
+    
+    print(f"Counties stored in database: {db_path}")
+
 def create_summary_report(all_counties: Dict[str, Any]):
     """
     Create a summary report of the county data
@@ -115,12 +187,11 @@ def create_summary_report(all_counties: Dict[str, Any]):
         })
     
     # Sort by county count (descending)
-    summary["states_summary"].sort(key=lambda x: x["county_count"], reverse=True)
+    summary["states_summary"].sort(key=itemgetter("county_count"), reverse=True)
     
-    # Save summary
+    # Save summary (compact; nothing downstream needs it pretty-printed)
     summary_file = os.path.join('..', 'meta_results', 'counties_summary.json')
-    with open(summary_file, 'w', encoding='utf-8') as file:
-        json.dump(summary, file, indent=2, ensure_ascii=False)
+    write_json_file(summary, summary_file, pretty=False)
     
     print(f"Summary report saved to: {summary_file}")
     
@@ -130,6 +201,9 @@ def create_summary_report(all_counties: Dict[str, Any]):
         print(f"  {i:2d}. {state['state_name']}: {state['county_count']} counties")
 
 if __name__ == "__main__":
+    # Re-queued and failed states are logged as warnings and errors
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s - %(message)s')
+    
     # Check if requests library is available
     try:
         import requests
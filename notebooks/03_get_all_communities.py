@@ -1,8 +1,44 @@
+import heapq
 import json
+import logging
 import requests
+import sqlite3
 import time
 import os
-from typing import Dict, List, Any
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from typing import Dict, Iterator, List, Any
+
+import fetch_cache
+from fema_utils import (REQUEST_TIMEOUT, FetchError, RateLimiter, create_session, enable_wal, fetch_with_requeue,
+                        write_json_file)
+
+# tqdm is optional; without it progress is printed every PROGRESS_EVERY counties
+try:
+    from tqdm.auto import tqdm
+except ImportError:
+    tqdm = None
+
+PROGRESS_EVERY = 100
+
+# Number of counties fetched concurrently
+MAX_WORKERS = 16
+
+# Most community lookups started per second across all workers
+REQUESTS_PER_SECOND = 20
+
+# Same retry policy as the counties script
+SESSION = create_session(
+    {'Accept-Encoding': 'gzip, deflate', 'User-Agent': 'cityplanner-fema/1.0'},
+    pool_size=MAX_WORKERS,
+    retries=5,
+    retry_statuses=(429, 500, 502, 503, 504),
+    retry_methods=('GET',)
+)
+
+# SQLite copy of the fetched communities, written in batches during the fetch
+METADATA_DB_PATH = os.path.join('..', 'meta_results', 'fema_metadata.db')
+DB_BATCH_SIZE = 1000
 
 def load_counties_data() -> Dict[str, Any]:
     """
@@ -12,29 +48,56 @@ def load_counties_data() -> Dict[str, Any]:
     with open(counties_file, 'r', encoding='utf-8') as file:
         return json.load(file)
 
-def fetch_communities_for_county(county_value: str, state_code: str, county_name: str, state_name: str) -> List[Dict[str, str]]:
+def create_communities_table(db_path: str = METADATA_DB_PATH) -> sqlite3.Connection:
+    """
+    Open the metadata database and make sure the communities table exists
+    """
+    # Transactions are managed explicitly so each batch commits exactly once
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    enable_wal(conn)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS communities (
+            state_code TEXT NOT NULL,
+            county_code TEXT NOT NULL,
+            community_code TEXT NOT NULL,
+            community_name TEXT,
+            PRIMARY KEY (state_code, county_code, community_code)
+        )
+    ''')
+    return conn
+
+def insert_community_rows(conn: sqlite3.Connection, rows: List[tuple]):
+    """
+    Insert a batch of (state_code, county_code, community_code, community_name) rows
+    """
+    conn.execute('BEGIN')
+    conn.executemany('INSERT OR IGNORE INTO communities VALUES (?, ?, ?, ?)', rows)
+    conn.execute('COMMIT')
+
+def fetch_communities_for_county(county_value: str, state_code: str, county_name: str, state_name: str,
+                                 rate_limiter: RateLimiter = None) -> List[Dict[str, str]]:
     """
     Fetch communities for a specific county from FEMA API
     """
     url = f"https://msc.fema.gov/portal/advanceSearch?getCommunity={county_value}&state={state_code}"
     
-    try:
-        print(f"Fetching communities for {county_name}, {state_name} (county: {county_value}, state: {state_code})...")
-        response = requests.get(url, timeout=30)
+    def request_communities():
+        if rate_limiter:
+            rate_limiter.acquire()
+        response = SESSION.get(url, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
         
         # Parse JSON response
-        communities_data = response.json()
-        
-        print(f"  Found {len(communities_data)} communities for {county_name}")
-        return communities_data
+        return response.json()
+    
+    try:
+        # A county fetched by an earlier run is read back from the checkpoint store
+        return fetch_cache.get_or_fetch(f"community:{state_code}:{county_value}", request_communities)
         
     except requests.exceptions.RequestException as e:
-        print(f"  Error fetching data for {county_name}: {e}")
-        return []
+        raise FetchError(f"Error fetching data for {county_name}, {state_name}: {e}") from e
     except json.JSONDecodeError as e:
-        print(f"  Error parsing JSON for {county_name}: {e}")
-        return []
+        raise FetchError(f"Error parsing JSON for {county_name}, {state_name}: {e}") from e
 
 def fetch_all_communities():
     """
@@ -54,71 +117,113 @@ def fetch_all_communities():
         "states": {}
     }
     
-    total_communities = 0
-    processed_counties = 0
-    
-    # Process each state
+    # Flatten the state/county hierarchy into one list of independent fetch tasks
+    tasks = []
     for state_code, state_data in counties_data["states"].items():
-        state_name = state_data["state_name"]
-        counties = state_data["counties"]
-        
-        print(f"\n=== Processing {state_name} ({len(counties)} counties) ===")
-        
-        # Initialize state structure
         all_communities["states"][state_code] = {
-            "state_name": state_name,
+            "state_name": state_data["state_name"],
             "state_code": state_code,
-            "county_count": len(counties),
+            "county_count": len(state_data["counties"]),
             "community_count": 0,
             "counties": {}
         }
-        
-        state_community_count = 0
-        
-        # Process each county in the state
-        for county in counties:
-            county_value = county["value"]
-            county_name = county["label"]
-            
-            # Fetch communities for this county
-            communities = fetch_communities_for_county(county_value, state_code, county_name, state_name)
-            
-            # Store in result structure
-            all_communities["states"][state_code]["counties"][county_value] = {
-                "county_name": county_name,
-                "county_code": county_value,
-                "community_count": len(communities),
-                "communities": communities
-            }
-            
-            state_community_count += len(communities)
-            total_communities += len(communities)
-            processed_counties += 1
-            
-            # Add small delay to be respectful to the API
-            time.sleep(0.3)
+        for county in state_data["counties"]:
+            tasks.append((state_code, state_data["state_name"], county))
+    
+    total_tasks = len(tasks)
+    print(f"Fetching communities for {total_tasks} counties with {MAX_WORKERS} workers...")
+    
+    rate_limiter = RateLimiter(REQUESTS_PER_SECOND)
+    processed_counties = 0
+    failed_counties = 0
+    total_communities = 0
+    
+    db_conn = create_communities_table()
+    pending_rows = []
+    progress_bar = tqdm(total=total_tasks, unit="county") if tqdm else None
+    
+    # Stream each county to NDJSON as soon as it completes; only counts stay in memory
+    ndjson_file = os.path.join('..', 'meta_results', 'all_communities_data.ndjson')
+    with open(ndjson_file, 'w', encoding='utf-8', buffering=1 << 20) as ndjson:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            def submit(task):
+                state_code, state_name, county = task
+                return executor.submit(fetch_communities_for_county, county["value"], state_code,
+                                       county["label"], state_name, rate_limiter)
             
-            # Progress update every 10 counties
-            if processed_counties % 10 == 0:
-                print(f"  Progress: {processed_counties}/{counties_data['metadata']['total_counties']} counties processed")
-        
-        # Update state community count
-        all_communities["states"][state_code]["community_count"] = state_community_count
-        print(f"  {state_name} completed: {state_community_count} communities in {len(counties)} counties")
+            for (state_code, state_name, county), communities in fetch_with_requeue(submit, tasks):
+                # Not cached, so a county given up on is fetched again by the next run
+                if communities is None:
+                    failed_counties += 1
+                    communities = []
+                
+                ndjson.write(json.dumps({
+                    "state_code": state_code,
+                    "county_code": county["value"],
+                    "county_name": county["label"],
+                    "communities": communities
+                }, ensure_ascii=False) + "\n")
+                
+                pending_rows.extend(
+                    (state_code, county["value"], community["value"], community["label"])
+                    for community in communities
+                )
+                if len(pending_rows) >= DB_BATCH_SIZE:
+                    insert_community_rows(db_conn, pending_rows)
+                    pending_rows.clear()
+                
+                state_entry = all_communities["states"][state_code]
+                state_entry["counties"][county["value"]] = {
+                    "county_name": county["label"],
+                    "county_code": county["value"],
+                    "community_count": len(communities)
+                }
+                state_entry["community_count"] += len(communities)
+                total_communities += len(communities)
+                processed_counties += 1
+                
+                # Progress is reported once per completed county, never from the workers
+                if progress_bar:
+                    progress_bar.update(1)
+                    progress_bar.set_postfix(state=state_code, found=len(communities), refresh=False)
+                elif processed_counties % PROGRESS_EVERY == 0:
+                    print(f"  Progress: {processed_counties}/{total_tasks} counties processed")
+                
+                if processed_counties % 10 == 0:
+                    ndjson.flush()
+    
+    if progress_bar:
+        progress_bar.close()
+    
+    if pending_rows:
+        insert_community_rows(db_conn, pending_rows)
+    db_conn.close()
     
     # Update total count
     all_communities["metadata"]["total_communities"] = total_communities
     
-    # Save to JSON file
+    # Restore the original county order in the index (workers complete out of order)
+    for state_code, state_data in counties_data["states"].items():
+        counties_index = all_communities["states"][state_code]["counties"]
+        all_communities["states"][state_code]["counties"] = {
+            county["value"]: counties_index[county["value"]] for county in state_data["counties"]
+        }
+    
+    # Save the index (metadata and counts, no community lists)
+    meta_file = os.path.join('..', 'meta_results', 'all_communities_data_meta.json')
+    write_json_file(all_communities, meta_file)
+    
+    # Assemble the nested JSON consumed by the downstream scripts
     output_file = os.path.join('..', 'meta_results', 'all_communities_data.json')
-    with open(output_file, 'w', encoding='utf-8') as json_file:
-        json.dump(all_communities, json_file, indent=2, ensure_ascii=False)
+    merge_ndjson_to_nested(ndjson_file, meta_file, output_file)
     
     print(f"\n=== FINAL RESULTS ===")
     print(f"Successfully fetched community data for all counties!")
     print(f"Total states: {counties_data['metadata']['total_states']}")
     print(f"Total counties: {counties_data['metadata']['total_counties']}")
     print(f"Total communities: {total_communities}")
+    if failed_counties:
+        print(f"Failed counties: {failed_counties} (not cached; rerun to fetch them)")
     print(f"Data saved to: {output_file}")
     
     # Create summary report
@@ -126,6 +231,58 @@ def fetch_all_communities():
     
     return all_communities
 
+def merge_ndjson_to_nested(ndjson_file: str, meta_file: str, output_file: str):
+    """
+    Stream the per-county NDJSON records into the nested all_communities JSON layout
+    
+    Only byte offsets of the NDJSON lines are held in memory; each county record is
+    read back and written out one at a time, in the order given by the index file.
+    Output is written without indentation to keep the file compact.
+    """
+    with open(meta_file, 'r', encoding='utf-8') as file:
+        index = json.load(file)
+    
+    # Locate every county record in one pass
+    offsets = {}
+    with open(ndjson_file, 'rb') as ndjson:
+        offset = ndjson.tell()
+        for line in iter(ndjson.readline, b''):
+            record = json.loads(line)
+            offsets[(record["state_code"], record["county_code"])] = offset
+            offset = ndjson.tell()
+    
+    with open(ndjson_file, 'rb') as ndjson, \
+            open(output_file, 'w', encoding='utf-8', buffering=1 << 20) as out:
+        out.write('{"metadata": ' + json.dumps(index["metadata"], ensure_ascii=False) + ', "states": {')
+        for state_position, (state_code, state_entry) in enumerate(index["states"].items()):
+            if state_position:
+                out.write(', ')
+            state_header = {key: value for key, value in state_entry.items() if key != "counties"}
+            out.write(json.dumps(state_code) + ': ' + json.dumps(state_header, ensure_ascii=False)[:-1] + ', "counties": {')
+            for county_position, (county_code, county_entry) in enumerate(state_entry["counties"].items()):
+                ndjson.seek(offsets[(state_code, county_code)])
+                communities = json.loads(ndjson.readline())["communities"]
+                if county_position:
+                    out.write(', ')
+                out.write(json.dumps(county_code) + ': ' + json.dumps(
+                    dict(county_entry, communities=communities), ensure_ascii=False))
+            out.write('}}')
+        out.write('}}')
+
+def iter_county_rows(all_communities: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """
+    Yield one summary row per county without building the full list
+    """
+    for state_code, state_data in all_communities["states"].items():
+        for county_code, county_data in state_data["counties"].items():
+            yield {
+                "state_name": state_data["state_name"],
+                "state_code": state_code,
+                "county_name": county_data["county_name"],
+                "county_code": county_code,
+                "community_count": county_data["community_count"]
+            }
+
 def create_summary_report(all_communities: Dict[str, Any]):
     """
     Create a summary report of the community data
@@ -141,9 +298,7 @@ def create_summary_report(all_communities: Dict[str, Any]):
         "counties_with_most_communities": []
     }
     
-    # Create summary for each state and collect county data
-    all_counties_list = []
-    
+    # Create summary for each state
     for state_code, state_data in all_communities["states"].items():
         summary["states_summary"].append({
             "state_code": state_code,
@@ -151,28 +306,17 @@ def create_summary_report(all_communities: Dict[str, Any]):
             "county_count": state_data["county_count"],
             "community_count": state_data["community_count"]
         })
-        
-        # Collect county data for top counties report
-        for county_code, county_data in state_data["counties"].items():
-            all_counties_list.append({
-                "state_name": state_data["state_name"],
-                "state_code": state_code,
-                "county_name": county_data["county_name"],
-                "county_code": county_code,
-                "community_count": county_data["community_count"]
-            })
     
     # Sort states by community count (descending)
-    summary["states_summary"].sort(key=lambda x: x["community_count"], reverse=True)
+    summary["states_summary"].sort(key=itemgetter("community_count"), reverse=True)
     
-    # Sort counties by community count and get top 20
-    all_counties_list.sort(key=lambda x: x["community_count"], reverse=True)
-    summary["counties_with_most_communities"] = all_counties_list[:20]
+    # Only the top 20 counties are reported, so select them without sorting the full list
+    summary["counties_with_most_communities"] = heapq.nlargest(
+        20, iter_county_rows(all_communities), key=itemgetter("community_count"))
     
-    # Save summary
+    # Save summary (compact; nothing downstream needs it pretty-printed)
     summary_file = os.path.join('..', 'meta_results', 'communities_summary.json')
-    with open(summary_file, 'w', encoding='utf-8') as file:
-        json.dump(summary, file, indent=2, ensure_ascii=False)
+    write_json_file(summary, summary_file, pretty=False)
     
     print(f"Summary report saved to: {summary_file}")
     
@@ -187,6 +331,9 @@ def create_summary_report(all_communities: Dict[str, Any]):
         print(f"  {i:2d}. {county['county_name']}, {county['state_name']}: {county['community_count']} communities")
 
 if __name__ == "__main__":
+    # Only failures are reported per county; progress goes through tqdm or periodic prints
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s - %(message)s')
+    
     # Check if requests library is available
     try:
         import requests
@@ -204,7 +351,7 @@ if __name__ == "__main__":
         print("\nTask completed successfully!")
         
     except KeyboardInterrupt:
-        print("\n\nProcess interrupted by user. Partial data may have been saved.")
+        print("\n\nProcess interrupted by user. Completed fetches are cached; rerun to resume.")
         exit(1)
     except Exception as e:
         print(f"Error during execution: {e}")
@@ -5,29 +5,176 @@ Script to fetch flood risk shapefile data for each state/county/community combin
 This script:
 1. Loads state/county/community data from sample files
 2. Creates SQLite database with proper schema
-3. Makes POST requests to FEMA portal for each combination
+3. Makes POST requests to FEMA portal for each combination, several at a time
 4. Extracts FLOOD_RISK_DB items where product_DESCRIPTION = "ShapeFiles"
 5. Stores the relevant shapefile information in SQLite database
 6. Automatically resumes from where it left off if interrupted
 
 Resume Capability:
 - Checks request_log table for already processed communities
-- Skips communities that have been successfully processed
+- Skips communities that have been successfully processed; failed ones are retried
 - Can be safely restarted after network interruptions
 - Shows progress: processed this run vs. skipped (already done)
+- Use --no-resume to discard stored shapefiles and fetch every community again
 """
 
-import json
+import argparse
 import requests
-import time
 import sqlite3
+import threading
 from datetime import datetime
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlencode
 
+from fema_utils import (PORTAL_SEARCH_HEADERS, RateLimiter, ResultWriter, create_session, enable_wal, json_loads,
+                        loads_json_object)
+
+# tqdm is optional; without it progress is printed every PROGRESS_EVERY communities
+try:
+    from tqdm.auto import tqdm
+except ImportError:
+    tqdm = None
+
+PROGRESS_EVERY = 500
+
+# Worker threads, i.e. the most requests ever in flight
+MAX_WORKERS = 16
+
+# Requests allowed in flight at start; adjusted between 1 and MAX_WORKERS as responses come in
+INITIAL_CONCURRENCY = 4
+
+# Consecutive unthrottled responses needed before one more request may be in flight
+CONCURRENCY_INCREASE_EVERY = 20
+
+# Status codes taken as a sign that the server is overloaded
+THROTTLE_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+# Requests started per second at most, whatever the current concurrency limit
+REQUESTS_PER_SECOND = 20
+
+# Buffered shapefile and request log rows written per transaction
+FLUSH_BATCH_SIZE = 10000
+
+# Fetched results that may wait for the writer thread; the crawl blocks once this many are queued
+RESULT_QUEUE_SIZE = 1000
+
+# Searches only read data, so both the POST and the GET form are safe to retry
+SESSION = create_session(
+    # Decoded transparently; 'br' would need the optional brotli package
+    {**PORTAL_SEARCH_HEADERS, 'Accept-Encoding': 'gzip, deflate'},
+    pool_size=MAX_WORKERS,
+    retries=5,
+    retry_statuses=(429, 502, 503, 504),
+    retry_methods=('GET', 'POST')
+)
+
+# Secondary indexes, dropped while the crawl bulk-loads rows and rebuilt once afterwards
+INDEXES = {
+    # Covers the state and state+county statistics joins (the rowid, shapefiles.id, is implicit)
+    'idx_shapefiles_codes': 'shapefiles (state_code, county_code, community_code)',
+    'idx_shapefiles_community': 'shapefiles (community_code)',
+    'idx_shapefiles_product_name': 'shapefiles (product_name)',
+    'idx_request_log_timestamp': 'request_log (request_timestamp)'
+}
+
+# Indexes that databases created by earlier versions still have. idx_shapefiles_codes leads with
+# both of their columns, so they are dropped with the others for the bulk load and not rebuilt
+SUPERSEDED_INDEXES = ('idx_shapefiles_state', 'idx_shapefiles_county')
+
+# FEMA item fields stored in shapefiles, in SHAPEFILE_INSERT_SQL column order after the three codes
+SHAPEFILE_ITEM_KEYS = (
+    'product_ID', 'product_TYPE_ID', 'product_SUBTYPE_ID',
+    'product_NAME', 'product_DESCRIPTION',
+    'product_EFFECTIVE_DATE', 'product_ISSUE_DATE',
+    'product_EFFECTIVE_DATE_STRING', 'product_POSTING_DATE',
+    'product_POSTING_DATE_STRING', 'product_ISSUE_DATE_STRING',
+    'product_EFFECTIVE_FLAG', 'product_FILE_PATH', 'product_FILE_SIZE'
+)
+
+SHAPEFILE_INSERT_SQL = '''
+    INSERT INTO shapefiles (
+        community_code, county_code, state_code,
+        product_id, product_type_id, product_subtype_id,
+        product_name, product_description,
+        product_effective_date, product_issue_date,
+        product_effective_date_string, product_posting_date,
+        product_posting_date_string, product_issue_date_string,
+        product_effective_flag, product_file_path, product_file_size
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+REQUEST_LOG_INSERT_SQL = '''
+    INSERT INTO request_log (community_code, county_code, state_code, success, error_message, shapefiles_found)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+def connect_database(db_path):
+    """Open a connection to the database with the bulk-load settings."""
+    # Autocommit mode; the bulk writers open their own transactions explicitly.
+    # A connection may be handed to another thread, but only one thread ever writes through it
+    conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+    
+    enable_wal(conn)
+    conn.execute('PRAGMA cache_size=-262144')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA mmap_size=268435456')
+    return conn
+
+class AdaptiveConcurrency:
+    """Additive-increase/multiplicative-decrease limit on requests in flight.
+    
+    Every CONCURRENCY_INCREASE_EVERY clean responses allow one more request in flight;
+    each throttled response (429/5xx, retried or not, or a timeout) halves the limit.
+    """
+    def __init__(self, initial, maximum, increase_every=CONCURRENCY_INCREASE_EVERY):
+        self.limit = initial
+        self.maximum = maximum
+        self.increase_every = increase_every
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+    
+    def acquire(self):
+        """Block until fewer than limit requests are in flight, then take a slot."""
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+    
+    def release(self, throttled):
+        """Give the slot back and adjust the limit from the request outcome."""
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes >= self.increase_every and self.limit < self.maximum:
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+def was_throttled(response):
+    """Tell whether the response, or any attempt the adapter retried before it, was throttled."""
+    if response.status_code in THROTTLE_STATUSES:
+        return True
+    retries = getattr(getattr(response, 'raw', None), 'retries', None)
+    return any(attempt.status in THROTTLE_STATUSES for attempt in getattr(retries, 'history', ()))
+
 def create_database(db_path):
     """Create SQLite database with proper schema."""
-    conn = sqlite3.connect(db_path)
+    conn = connect_database(db_path)
+    create_schema(conn)
+    return conn
+
+def create_schema(conn):
+    """Create the tables (without secondary indexes).
+    
+    FEMA codes keep leading zeros and CIDs may contain letters (e.g. 01001C), so they stay
+    TEXT; the lookup tables are WITHOUT ROWID so rows live directly in the primary key B-tree.
+    """
     cursor = conn.cursor()
     
     # Create states table
@@ -36,7 +183,7 @@ def create_database(db_path):
             state_code TEXT PRIMARY KEY,
             state_name TEXT NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
+        ) WITHOUT ROWID
     ''')
     
     # Create counties table
@@ -47,7 +194,7 @@ def create_database(db_path):
             state_code TEXT NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (state_code) REFERENCES states (state_code)
-        )
+        ) WITHOUT ROWID
     ''')
     
     # Create communities table
@@ -60,7 +207,7 @@ def create_database(db_path):
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (county_code) REFERENCES counties (county_code),
             FOREIGN KEY (state_code) REFERENCES states (state_code)
-        )
+        ) WITHOUT ROWID
     ''')
     
     # Create shapefiles table
@@ -106,27 +253,27 @@ def create_database(db_path):
         )
     ''')
     
-    # Create indexes for better performance
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_shapefiles_state ON shapefiles (state_code)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_shapefiles_county ON shapefiles (county_code)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_shapefiles_community ON shapefiles (community_code)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_shapefiles_product_name ON shapefiles (product_name)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_request_log_timestamp ON request_log (request_timestamp)')
-    
-    conn.commit()
-    return conn
+def create_indexes(conn):
+    """Create indexes for better query performance."""
+    for index_name, index_target in INDEXES.items():
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {index_target}')
+
+def drop_indexes(conn):
+    """Drop secondary indexes so bulk inserts only append to the table B-trees."""
+    for index_name in (*INDEXES, *SUPERSEDED_INDEXES):
+        conn.execute(f'DROP INDEX IF EXISTS {index_name}')
 
 def load_data():
     """Load county and community data from meta_results."""
     print("Loading data from meta_results...")
     
     # Load counties data
-    with open('meta_results/all_counties_data.json', 'r') as f:
-        counties_data = json.load(f)
+    with open('meta_results/all_counties_data.json', 'rb') as f:
+        counties_data = json_loads(f.read())
     
     # Load communities data
-    with open('meta_results/all_communities_data.json', 'r') as f:
-        communities_data = json.load(f)
+    with open('meta_results/all_communities_data.json', 'rb') as f:
+        communities_data = json_loads(f.read())
     
     return counties_data, communities_data
 
@@ -136,30 +283,39 @@ def populate_base_data(conn, counties_data, communities_data):
     
     print("Populating base data...")
     
+    # Take the write lock up front rather than on the first insert
+    cursor.execute('BEGIN IMMEDIATE')
+    
+    states = communities_data['states']
+    
     # Insert states
-    for state_code, state_info in communities_data['states'].items():
-        cursor.execute('''
-            INSERT OR REPLACE INTO states (state_code, state_name)
-            VALUES (?, ?)
-        ''', (state_code, state_info['state_name']))
-    
-    # Insert counties and communities
-    for state_code, state_info in communities_data['states'].items():
-        for county_code, county_info in state_info['counties'].items():
-            # Insert county
-            cursor.execute('''
-                INSERT OR REPLACE INTO counties (county_code, county_name, state_code)
-                VALUES (?, ?, ?)
-            ''', (county_code, county_info['county_name'], state_code))
-            
-            # Insert communities
-            for community in county_info['communities']:
-                cursor.execute('''
-                    INSERT OR REPLACE INTO communities (community_code, community_name, county_code, state_code)
-                    VALUES (?, ?, ?, ?)
-                ''', (community['value'], community['label'], county_code, state_code))
-    
-    conn.commit()
+    cursor.executemany('''
+        INSERT OR REPLACE INTO states (state_code, state_name)
+        VALUES (?, ?)
+    ''', [(state_code, state_info['state_name']) for state_code, state_info in states.items()])
+    
+    # Insert counties
+    cursor.executemany('''
+        INSERT OR REPLACE INTO counties (county_code, county_name, state_code)
+        VALUES (?, ?, ?)
+    ''', [
+        (county_code, county_info['county_name'], state_code)
+        for state_code, state_info in states.items()
+        for county_code, county_info in state_info['counties'].items()
+    ])
+    
+    # Insert communities
+    cursor.executemany('''
+        INSERT OR REPLACE INTO communities (community_code, community_name, county_code, state_code)
+        VALUES (?, ?, ?, ?)
+    ''', [
+        (community['value'], community['label'], county_code, state_code)
+        for state_code, state_info in states.items()
+        for county_code, county_info in state_info['counties'].items()
+        for community in county_info['communities']
+    ])
+    
+    cursor.execute('COMMIT')
     print("Base data populated successfully.")
 
 def create_form_data(state_code, county_code, community_code):
@@ -181,129 +337,150 @@ def create_form_data(state_code, county_code, community_code):
         'method': 'search'
     }
 
-def fetch_flood_risk_data(conn, state_code, county_code, community_code, community_name):
-    """Fetch flood risk data for a specific state/county/community combination."""
+def create_form_body(state_code, county_code, community_code):
+    """Create the urlencoded POST body for one community."""
+    return urlencode(create_form_data(state_code, county_code, community_code)).encode()
+
+def fetch_flood_risk_data(state_code, county_code, community_code, community_name, rate_limiter=None,
+                          concurrency=None):
+    """Fetch the ShapeFiles items for a specific state/county/community combination.
+    
+    Runs in a worker thread, so it only talks to the network; the caller stores the result.
+    """
     url = 'https://msc.fema.gov/portal/advanceSearch'
-    cursor = conn.cursor()
     
-    form_data = create_form_data(state_code, county_code, community_code)
+    # Encoded once; the adapter's retries resend these same bytes
+    form_body = create_form_body(state_code, county_code, community_code)
     
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        'Content-Type': 'application/x-www-form-urlencoded',
-        'Accept': 'application/json, text/javascript, */*; q=0.01',
-        'X-Requested-With': 'XMLHttpRequest'
-    }
+    throttled = False
+    if concurrency:
+        concurrency.acquire()
     
     try:
-        response = requests.post(url, data=form_data, headers=headers, timeout=30)
+        # The limiter is taken per request, so bursts are capped without idling between them
+        if rate_limiter:
+            rate_limiter.acquire()
+        response = SESSION.post(url, data=form_body, timeout=30)
+        throttled = was_throttled(response)
         response.raise_for_status()
         
-        data = response.json()
-        
-        # Extract FLOOD_RISK_DB items with ShapeFiles
-        shapefiles_found = 0
-        if 'FLOOD_RISK_DB' in data:
-            for item in data['FLOOD_RISK_DB']:
-                if item.get('product_DESCRIPTION') == 'ShapeFiles':
-                    # Insert shapefile data
-                    cursor.execute('''
-                        INSERT INTO shapefiles (
-                            community_code, county_code, state_code,
-                            product_id, product_type_id, product_subtype_id,
-                            product_name, product_description,
-                            product_effective_date, product_issue_date,
-                            product_effective_date_string, product_posting_date,
-                            product_posting_date_string, product_issue_date_string,
-                            product_effective_flag, product_file_path, product_file_size
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        community_code, county_code, state_code,
-                        item.get('product_ID'), item.get('product_TYPE_ID'), item.get('product_SUBTYPE_ID'),
-                        item.get('product_NAME'), item.get('product_DESCRIPTION'),
-                        item.get('product_EFFECTIVE_DATE'), item.get('product_ISSUE_DATE'),
-                        item.get('product_EFFECTIVE_DATE_STRING'), item.get('product_POSTING_DATE'),
-                        item.get('product_POSTING_DATE_STRING'), item.get('product_ISSUE_DATE_STRING'),
-                        item.get('product_EFFECTIVE_FLAG'), item.get('product_FILE_PATH'), item.get('product_FILE_SIZE')
-                    ))
-                    shapefiles_found += 1
+        # A list or null body is a failed request, not a community without shapefiles
+        data = loads_json_object(response.content)
         
-        # Log successful request
-        cursor.execute('''
-            INSERT INTO request_log (community_code, county_code, state_code, success, shapefiles_found)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (community_code, county_code, state_code, True, shapefiles_found))
-        
-        conn.commit()
+        # Extract FLOOD_RISK_DB items with ShapeFiles, already shaped as shapefiles rows
+        rows = [
+            (community_code, county_code, state_code, *map(item.get, SHAPEFILE_ITEM_KEYS))
+            for item in data.get('FLOOD_RISK_DB', ())
+            if item.get('product_DESCRIPTION') == 'ShapeFiles'
+        ]
         
         return {
             'success': True,
-            'shapefiles_found': shapefiles_found
+            'rows': rows
         }
         
     except requests.exceptions.RequestException as e:
+        # Exhausted retries and timeouts also mean the server is not keeping up
+        throttled = throttled or isinstance(e, (requests.exceptions.RetryError, requests.exceptions.Timeout))
         error_msg = str(e)
         print(f"Error fetching data for {community_name} ({community_code}): {error_msg}")
         
-        # Log failed request
-        cursor.execute('''
-            INSERT INTO request_log (community_code, county_code, state_code, success, error_message, shapefiles_found)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (community_code, county_code, state_code, False, error_msg, 0))
-        
-        conn.commit()
-        
         return {
             'success': False,
-            'error': error_msg,
-            'shapefiles_found': 0
+            'error': error_msg
         }
-    except json.JSONDecodeError as e:
+    except ValueError as e:
         error_msg = f"JSON decode error: {str(e)}"
         print(f"Error parsing JSON for {community_name} ({community_code}): {error_msg}")
         
-        # Log failed request
-        cursor.execute('''
-            INSERT INTO request_log (community_code, county_code, state_code, success, error_message, shapefiles_found)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (community_code, county_code, state_code, False, error_msg, 0))
-        
-        conn.commit()
-        
         return {
             'success': False,
-            'error': error_msg,
-            'shapefiles_found': 0
+            'error': error_msg
         }
+    finally:
+        if concurrency:
+            concurrency.release(throttled)
 
-def get_processed_communities(conn):
-    """Get set of already processed communities."""
-    cursor = conn.cursor()
-    cursor.execute('SELECT community_code FROM request_log')
-    return set(row[0] for row in cursor.fetchall())
-
-def get_statistics(conn):
-    """Get statistics from the database."""
-    cursor = conn.cursor()
+def buffer_flood_risk_result(shapefile_rows, log_rows, state_code, county_code, community_code, result):
+    """Queue the shapefile and request log rows for one fetched community.
     
-    # Total counts
-    cursor.execute('SELECT COUNT(*) FROM states')
-    total_states = cursor.fetchone()[0]
+    Returns the number of shapefiles found.
+    """
+    if not result['success']:
+        # Log failed request
+        log_rows.append((community_code, county_code, state_code, False, result['error'], 0))
+        return 0
     
-    cursor.execute('SELECT COUNT(*) FROM counties')
-    total_counties = cursor.fetchone()[0]
+    shapefile_rows.extend(result['rows'])
+    shapefiles_found = len(result['rows'])
     
-    cursor.execute('SELECT COUNT(*) FROM communities')
-    total_communities = cursor.fetchone()[0]
+    # Log successful request
+    log_rows.append((community_code, county_code, state_code, True, None, shapefiles_found))
+    return shapefiles_found
+
+def flush_results(conn, shapefile_rows, log_rows):
+    """Write the buffered rows in a single transaction and empty the buffers."""
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
     
-    cursor.execute('SELECT COUNT(*) FROM shapefiles')
-    total_shapefiles = cursor.fetchone()[0]
+    try:
+        cursor.executemany(SHAPEFILE_INSERT_SQL, shapefile_rows)
+        cursor.executemany(REQUEST_LOG_INSERT_SQL, log_rows)
+        cursor.execute('COMMIT')
+    except BaseException:
+        # Leave the connection outside any transaction; the buffers keep the rows that were not written.
+        # SQLite may already have rolled back on its own, e.g. after a full disk
+        if conn.in_transaction:
+            cursor.execute('ROLLBACK')
+        raise
+    
+    shapefile_rows.clear()
+    log_rows.clear()
+
+class FloodRiskResultWriter(ResultWriter):
+    """Writer thread buffering shapefile and request log rows, flushed FLUSH_BATCH_SIZE rows at a time."""
+    def __init__(self, db_path, maxsize=RESULT_QUEUE_SIZE):
+        super().__init__(lambda: connect_database(db_path), maxsize)
+        self.shapefile_rows = []
+        self.log_rows = []
+    
+    def write(self, conn, item):
+        buffer_flood_risk_result(self.shapefile_rows, self.log_rows, *item)
+        if len(self.shapefile_rows) + len(self.log_rows) >= FLUSH_BATCH_SIZE:
+            self.flush(conn)
+    
+    def flush(self, conn):
+        flush_results(conn, self.shapefile_rows, self.log_rows)
+
+def get_processed_communities(conn):
+    """Get set of (state_code, county_code, community_code) already fetched successfully."""
+    cursor = conn.cursor()
+    cursor.execute('SELECT DISTINCT state_code, county_code, community_code FROM request_log WHERE success = 1')
+    return set(cursor.fetchall())
+
+def get_statistics(conn, counts=None):
+    """Get statistics from the database.
     
-    cursor.execute('SELECT COUNT(*) FROM request_log WHERE success = 1')
-    successful_requests = cursor.fetchone()[0]
+    counts, when given, is the (states, counties, communities, shapefiles, successful
+    requests, failed requests) tuple already tracked by the caller; the COUNT(*) scans
+    are only run without it.
+    """
+    cursor = conn.cursor()
     
-    cursor.execute('SELECT COUNT(*) FROM request_log WHERE success = 0')
-    failed_requests = cursor.fetchone()[0]
+    # Total counts, in a single statement
+    if counts is None:
+        cursor.execute('''
+            SELECT
+                (SELECT COUNT(*) FROM states),
+                (SELECT COUNT(*) FROM counties),
+                (SELECT COUNT(*) FROM communities),
+                (SELECT COUNT(*) FROM shapefiles),
+                (SELECT COUNT(*) FROM request_log WHERE success = 1),
+                (SELECT COUNT(*) FROM request_log WHERE success = 0)
+        ''')
+        counts = cursor.fetchone()
+    (total_states, total_counties, total_communities,
+     total_shapefiles, successful_requests, failed_requests) = counts
     
     # Top states by shapefile count
     cursor.execute('''
@@ -321,7 +498,7 @@ def get_statistics(conn):
         SELECT c.county_name, c.county_code, s.state_name, COUNT(sf.id) as shapefile_count
         FROM counties c
         JOIN states s ON c.state_code = s.state_code
-        LEFT JOIN shapefiles sf ON c.county_code = sf.county_code
+        LEFT JOIN shapefiles sf ON c.state_code = sf.state_code AND c.county_code = sf.county_code
         GROUP BY c.county_code, c.county_name, s.state_name
         ORDER BY shapefile_count DESC
         LIMIT 10
@@ -355,6 +532,12 @@ def get_statistics(conn):
 
 def main():
     """Main function to process all state/county/community combinations."""
+    parser = argparse.ArgumentParser(description='Fetch FEMA flood risk shapefile metadata')
+    parser.add_argument('--resume', action=argparse.BooleanOptionalAction, default=True,
+                        help='Skip communities already fetched successfully (default: on)')
+    
+    args = parser.parse_args()
+    
     print("Starting flood risk shapefile data collection...")
     print("=" * 60)
     
@@ -368,14 +551,18 @@ def main():
     # Load data
     counties_data, communities_data = load_data()
     
+    # Flatten the state/county/community hierarchy once; the crawl iterates this list
+    combinations = [
+        (state_code, county_code, community['value'], community['label'])
+        for state_code, state_info in communities_data['states'].items()
+        for county_code, county_info in state_info['counties'].items()
+        for community in county_info['communities']
+    ]
+    
     # Calculate totals for progress tracking
     total_states = len(communities_data['states'])
     total_counties = sum(len(state_info['counties']) for state_info in communities_data['states'].values())
-    total_communities = sum(
-        len(county_info['communities'])
-        for state_info in communities_data['states'].values()
-        for county_info in state_info['counties'].values()
-    )
+    total_communities = len(combinations)
     
     print(f"Dataset Overview:")
     print(f"  Total States: {total_states}")
@@ -387,64 +574,91 @@ def main():
     populate_base_data(conn, counties_data, communities_data)
     
     # Get already processed communities for resume capability
-    processed_communities = get_processed_communities(conn)
-    print(f"Found {len(processed_communities)} already processed communities")
+    if args.resume:
+        processed_communities = get_processed_communities(conn)
+        print(f"Found {len(processed_communities)} already processed communities")
+    else:
+        # Everything is fetched again, so drop the previous results to avoid duplicates. Their
+        # success rows go in the same transaction: a community that fails or is not reached in
+        # this run must be fetched by the next resumed run, not skipped with its shapefiles gone
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('DELETE FROM shapefiles')
+        conn.execute('DELETE FROM request_log WHERE success = 1')
+        conn.execute('COMMIT')
+        processed_communities = set()
+        print("Resume disabled: fetching all communities again")
     
     total_processed = 0
     total_shapefiles_found = 0
-    county_processed = 0
-    skipped_count = 0
+    failed_count = 0
     
-    # Process each state
-    for state_code, state_info in communities_data['states'].items():
-        state_name = state_info['state_name']
-        print(f"\nProcessing state: {state_name} ({state_code})")
-        
-        # Process each county in the state
-        for county_code, county_info in state_info['counties'].items():
-            county_processed += 1
-            county_name = county_info['county_name']
-            county_community_count = len(county_info['communities'])
-            
-            print(f"  Processing county: {county_name} ({county_code}) - County {county_processed}/{total_counties}")
-            print(f"    Communities in this county: {county_community_count}")
-            
-            county_start_processed = total_processed
-            
-            # Process each community in the county
-            for community in county_info['communities']:
-                community_code = community['value']
-                community_name = community['label']
-                
-                # Skip if already processed
-                if community_code in processed_communities:
-                    print(f"    Skipping already processed community: {community_name} ({community_code})")
-                    skipped_count += 1
-                    continue
-                
-                print(f"    Processing community: {community_name} ({community_code})")
-                
-                # Fetch flood risk data
-                result = fetch_flood_risk_data(conn, state_code, county_code, community_code, community_name)
+    # Collect the communities still to fetch, skipping those already processed
+    tasks = [task for task in combinations if task[:3] not in processed_communities]
+    skipped_count = len(combinations) - len(tasks)
+    
+    print(f"Skipping {skipped_count} already processed communities")
+    print(f"\nFetching {len(tasks)} communities with up to {MAX_WORKERS} workers...")
+    
+    rate_limiter = RateLimiter(REQUESTS_PER_SECOND)
+    concurrency = AdaptiveConcurrency(INITIAL_CONCURRENCY, MAX_WORKERS)
+    
+    # Bulk-load without secondary indexes; they are rebuilt after the crawl
+    drop_indexes(conn)
+    
+    # A single writer thread owns all inserts; this thread only queues results
+    writer = FloodRiskResultWriter(db_path)
+    writer.start()
+    
+    progress_bar = tqdm(total=len(tasks), unit='comm') if tqdm else None
+    
+    # Fetch concurrently; results are handed to the writer thread as they complete
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {executor.submit(fetch_flood_risk_data, *task, rate_limiter, concurrency): task for task in tasks}
+            for future in as_completed(futures):
+                state_code, county_code, community_code, community_name = futures[future]
+                result = future.result()
+                writer.put((state_code, county_code, community_code, result))
+                shapefiles_found = len(result['rows']) if result['success'] else 0
                 
                 # Update counters
                 total_processed += 1
-                total_shapefiles_found += result['shapefiles_found']
+                total_shapefiles_found += shapefiles_found
+                if not result['success']:
+                    failed_count += 1
                 
                 # Progress update
-                # if total_processed % 5 == 0:
-                #     progress_percent = (total_processed / total_communities) * 100
-                #     print(f"    Progress: {total_processed}/{total_communities} communities processed ({progress_percent:.1f}%), {total_shapefiles_found} shapefiles found")
-                
-                # Rate limiting - wait between requests
-                time.sleep(0.1)
-            
-            # County completion summary
-            county_communities_processed = total_processed - county_start_processed
-            print(f"  ✓ Completed county: {county_name} - {county_communities_processed} communities processed")
-    
-    # Get final statistics
-    stats = get_statistics(conn)
+                if progress_bar:
+                    progress_bar.update(1)
+                    progress_bar.set_postfix(shapefiles=total_shapefiles_found, ok=total_processed - failed_count,
+                                             fail=failed_count, concurrency=concurrency.limit, refresh=False)
+                elif total_processed % PROGRESS_EVERY == 0:
+                    progress_percent = (total_processed / len(tasks)) * 100
+                    print(f"    Progress: {total_processed}/{len(tasks)} communities processed ({progress_percent:.1f}%), "
+                          f"{total_shapefiles_found} shapefiles found, {failed_count} failed, "
+                          f"concurrency {concurrency.limit}")
+    finally:
+        if progress_bar:
+            progress_bar.close()
+        
+        # Let the writer flush everything queued so far, even if the run is interrupted
+        writer.close()
+        
+        # Rebuild the indexes dropped for the bulk load, so an interrupted run leaves a usable database
+        create_indexes(conn)
+    
+    if writer.error is not None:
+        raise RuntimeError("Writing results to the database failed") from writer.error
+    
+    # Get final statistics; totals come from the counters kept during the crawl
+    stats = get_statistics(conn, counts=(
+        total_states,
+        total_counties,
+        len({community_code for _, _, community_code, _ in combinations}),
+        total_shapefiles_found,
+        total_processed - failed_count,
+        failed_count
+    ))
     
     # Generate summary
     print("\n" + "=" * 60)
@@ -455,9 +669,9 @@ def main():
     print(f"Total communities in database: {stats['total_communities']}")
     print(f"Communities processed this run: {total_processed}")
     print(f"Communities skipped (already processed): {skipped_count}")
-    print(f"Total shapefiles found: {stats['total_shapefiles']}")
-    print(f"Successful requests: {stats['successful_requests']}")
-    print(f"Failed requests: {stats['failed_requests']}")
+    print(f"Shapefiles found this run: {stats['total_shapefiles']}")
+    print(f"Successful requests this run: {stats['successful_requests']}")
+    print(f"Failed requests this run: {stats['failed_requests']}")
     
     print(f"\nDatabase saved to: {db_path}")
     
@@ -10,6 +10,9 @@ This script:
 5. Stores the relevant GDB information in SQLite database
 6. Automatically resumes from where it left off if interrupted
 
+States are fetched concurrently by a small thread pool; all database
+writes go through a single writer thread as results come back.
+
 Resume Capability:
 - Checks nfhl_request_log table for already processed states
 - Skips states that have been successfully processed
@@ -17,17 +20,122 @@ Resume Capability:
 - Shows progress: processed this run vs. skipped (already done)
 """
 
+import atexit
 import json
 import requests
-import time
 import sqlite3
+from collections import deque
 from datetime import datetime
 import os
-from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import quote_plus
+
+import fetch_cache
+from fema_utils import (PORTAL_SEARCH_HEADERS, FetchError, RateLimiter, ResultWriter, create_session, enable_wal,
+                        json_loads, loads_json_object)
+
+# Number of states fetched concurrently; database writes go through one writer thread
+MAX_WORKERS = 8
+
+# Upper bound on requests started per second across all workers, to stay polite to the FEMA portal
+REQUESTS_PER_SECOND = 2
+
+# States stored per transaction; a crash loses at most this many states, which are then re-fetched
+COMMIT_EVERY_STATES = 10
+
+# Most fetched states waiting for the writer thread
+RESULT_QUEUE_SIZE = 100
+
+# pool_block keeps the whole run to at most MAX_WORKERS TLS handshakes. The search POST only
+# reads data, so it is safe to retry
+SESSION = create_session(
+    PORTAL_SEARCH_HEADERS,
+    pool_size=MAX_WORKERS,
+    retries=3,
+    retry_statuses=(429, 500, 502, 503, 504),
+    retry_methods=('POST',),
+    backoff_factor=1,
+    pool_block=True
+)
+
+# Kept as constants so SQLite's statement cache reuses the compiled inserts across states.
+# Products already stored for a state are ignored, so re-fetching a state never duplicates rows
+INSERT_GDB_SQL = '''
+    INSERT OR IGNORE INTO gdb_nfhl (
+        state_code,
+        product_id, product_type_id, product_subtype_id,
+        product_name, product_description,
+        product_effective_date, product_issue_date,
+        product_effective_date_string, product_posting_date,
+        product_posting_date_string, product_issue_date_string,
+        product_effective_flag, product_file_path, product_file_size
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# Search form fields, urlencoded once; only the state, county and community codes vary per request
+FORM_BODY_TEMPLATE = (
+    'utf8=%E2%9C%93&affiliate=fema&query='
+    '&selstate={state}&selcounty={county}&selcommunity={community}'
+    '&jurisdictionkey=&jurisdictionvalue=&searchedCid={community}'
+    '&searchedDateStart=&searchedDateEnd=&txtstartdate=&txtenddate=&method=search'
+)
+
+# FEMA item fields stored in gdb_nfhl, in INSERT_GDB_SQL column order after state_code
+GDB_ITEM_KEYS = (
+    'product_ID', 'product_TYPE_ID', 'product_SUBTYPE_ID',
+    'product_NAME', 'product_DESCRIPTION',
+    'product_EFFECTIVE_DATE', 'product_ISSUE_DATE',
+    'product_EFFECTIVE_DATE_STRING', 'product_POSTING_DATE',
+    'product_POSTING_DATE_STRING', 'product_ISSUE_DATE_STRING',
+    'product_EFFECTIVE_FLAG', 'product_FILE_PATH', 'product_FILE_SIZE'
+)
+
+INSERT_LOG_SUCCESS_SQL = '''
+    INSERT INTO nfhl_request_log (state_code, success, gdb_found)
+    VALUES (?, 1, ?)
+'''
+
+INSERT_LOG_FAIL_SQL = '''
+    INSERT INTO nfhl_request_log (state_code, success, error_message, gdb_found)
+    VALUES (?, 0, ?, 0)
+'''
+
+# Parsed responses are checkpointed in the shared fetch cache, so a rerun replays recent ones
+# instead of asking FEMA again; this script runs from the repository root
+FETCH_CACHE_PATH = 'meta_results/fetch_cache.db'
+RESPONSE_CACHE_MAX_AGE = 24 * 60 * 60
+
+# Bodies of the most recent unparseable responses, written out once when the script exits
+DEBUG_RESPONSE_LIMIT = 16
+DEBUG_RESPONSE_BYTES = 8192
+DEBUG_RESPONSES_FILE = 'debug_responses.txt'
+DEBUG_RESPONSES = deque(maxlen=DEBUG_RESPONSE_LIMIT)
+
+def write_debug_responses():
+    """Write the retained unparseable responses to DEBUG_RESPONSES_FILE, if there are any."""
+    if not DEBUG_RESPONSES:
+        return
+    with open(DEBUG_RESPONSES_FILE, 'w', encoding='utf-8') as f:
+        for state_code, timestamp, body in DEBUG_RESPONSES:
+            f.write(f"===== state {state_code} at {timestamp} =====\n{body}\n\n")
+
+atexit.register(write_debug_responses)
+
+def connect_database(db_path):
+    """Open a connection to the database with the write-tuned settings."""
+    # Room for every statement this script prepares, so none is ever recompiled
+    conn = sqlite3.connect(db_path, cached_statements=256, isolation_level='DEFERRED')
+    
+    # Before any schema work, so the database is created in WAL mode
+    enable_wal(conn)
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-20000')
+    conn.execute('PRAGMA mmap_size=268435456')
+    return conn
 
 def create_database(db_path):
     """Create SQLite database with proper schema."""
-    conn = sqlite3.connect(db_path)
+    conn = connect_database(db_path)
     cursor = conn.cursor()
     
     # Create nfhl_states table
@@ -79,7 +187,21 @@ def create_database(db_path):
     # Create indexes for better performance
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_gdb_nfhl_state ON gdb_nfhl (state_code)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_gdb_nfhl_product_name ON gdb_nfhl (product_name)')
+    
+    # One row per product and state, so a re-fetched state's INSERT OR IGNORE adds no duplicates.
+    # Databases from before this key may already hold some; keep the first copy of each.
+    # Rows without a product_id are left alone, as the unique index allows repeated NULLs
+    cursor.execute('''
+        DELETE FROM gdb_nfhl
+        WHERE product_id IS NOT NULL
+          AND id NOT IN (
+              SELECT MIN(id) FROM gdb_nfhl WHERE product_id IS NOT NULL GROUP BY state_code, product_id
+          )
+    ''')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_gdb_nfhl_state_product ON gdb_nfhl (state_code, product_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_nfhl_request_log_timestamp ON nfhl_request_log (request_timestamp)')
+    # Covers the resume lookup: equality on success first, state_code read from the index
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_nfhl_request_log_state_success ON nfhl_request_log (success, state_code)')
     
     conn.commit()
     return conn
@@ -89,12 +211,12 @@ def load_data():
     print("Loading data from meta_results...")
     
     # Load counties data
-    with open('meta_results/all_counties_data.json', 'r') as f:
-        counties_data = json.load(f)
+    with open('meta_results/all_counties_data.json', 'rb') as f:
+        counties_data = json_loads(f.read())
     
     # Load communities data
-    with open('meta_results/all_communities_data.json', 'r') as f:
-        communities_data = json.load(f)
+    with open('meta_results/all_communities_data.json', 'rb') as f:
+        communities_data = json_loads(f.read())
     
     return counties_data, communities_data
 
@@ -105,59 +227,28 @@ def populate_base_data(conn, communities_data):
     print("Populating base data...")
     
     # Insert states
-    for state_code, state_info in communities_data['states'].items():
-        cursor.execute('''
-            INSERT OR REPLACE INTO nfhl_states (state_code, state_name)
-            VALUES (?, ?)
-        ''', (state_code, state_info['state_name']))
+    cursor.executemany('''
+        INSERT OR REPLACE INTO nfhl_states (state_code, state_name)
+        VALUES (?, ?)
+    ''', [(state_code, state_info['state_name']) for state_code, state_info in communities_data['states'].items()])
     
     conn.commit()
     print("Base data populated successfully.")
 
-def create_form_data(state_code, county_code=None, community_code=None):
-    """Create form data for POST request."""
-    # If county_code and community_code are not provided, use default values
-    if county_code is None:
-        county_code = f"{state_code}001"  # Use first county in state
-    
-    if community_code is None:
-        community_code = f"{county_code}C"  # Use default community code format
-    
-    return {
-        'utf8': '✓',
-        'affiliate': 'fema',
-        'query': '',
-        'selstate': state_code,
-        'selcounty': county_code,
-        'selcommunity': community_code,
-        'jurisdictionkey': '',
-        'jurisdictionvalue': '',
-        'searchedCid': community_code,
-        'searchedDateStart': '',
-        'searchedDateEnd': '',
-        'txtstartdate': '',
-        'txtenddate': '',
-        'method': 'search'
-    }
+def create_form_body(state_code, county_code, community_code):
+    """Create the urlencoded POST body by filling the three codes into FORM_BODY_TEMPLATE."""
+    return FORM_BODY_TEMPLATE.format(
+        state=quote_plus(state_code),
+        county=quote_plus(county_code),
+        community=quote_plus(community_code)
+    ).encode()
 
-def fetch_nfhl_state_data(conn, state_code, state_name, counties_data=None):
-    """Fetch NFHL state GDB data for a specific state."""
-    url = 'https://msc.fema.gov/portal/advanceSearch'
-    cursor = conn.cursor()
-    
-    # Check if we already have a record for this state
-    cursor.execute('''
-        SELECT product_file_path FROM gdb_nfhl WHERE state_code = ?
-    ''', (state_code,))
-    existing_file_path = cursor.fetchone()
+def fetch_nfhl_state_data(state_code, state_name, counties_data=None, rate_limiter=None):
+    """Fetch NFHL state GDB items for a specific state.
     
-    if existing_file_path:
-        print(f"  Skipping state {state_name} ({state_code}) - already have GDB data")
-        return {
-            'success': True,
-            'gdb_found': 0,
-            'skipped': True
-        }
+    Called from the worker pool and does no database work; main passes the result to the writer.
+    """
+    url = 'https://msc.fema.gov/portal/advanceSearch'
     
     # Try to find a valid county and community code for this state
     county_code = None
@@ -176,149 +267,135 @@ def fetch_nfhl_state_data(conn, state_code, state_name, counties_data=None):
         county_code = f"{state_code}001"
         community_code = f"{county_code}C"
     
-    form_data = create_form_data(state_code, county_code, community_code)
+    form_body = create_form_body(state_code, county_code, community_code)
     
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        'Content-Type': 'application/x-www-form-urlencoded',
-        'Accept': 'application/json, text/javascript, */*; q=0.01',
-        'X-Requested-With': 'XMLHttpRequest'
-    }
-    
-    try:
-        response = requests.post(url, data=form_data, headers=headers, timeout=30)
+    def request_effective():
+        # The limiter is taken when the request is issued, so there is no fixed sleep between states
+        if rate_limiter:
+            rate_limiter.acquire()
+        response = SESSION.post(url, data=form_body, timeout=30)
         response.raise_for_status()
         
         # Check if response is HTML instead of JSON (error page)
+        # Only sniff the body when the server does not say it is JSON; the sniff works on the raw bytes
         content_type = response.headers.get('Content-Type', '')
-        if 'text/html' in content_type or response.text.strip().startswith(('<!DOCTYPE', '<html')):
-            error_msg = f"Received HTML response instead of JSON for state {state_name} ({state_code})"
-            print(error_msg)
-            
-            # Log failed request
-            cursor.execute('''
-                INSERT INTO nfhl_request_log (state_code, success, error_message, gdb_found)
-                VALUES (?, ?, ?, ?)
-            ''', (state_code, False, error_msg, 0))
-            
-            conn.commit()
-            
-            return {
-                'success': False,
-                'error': error_msg,
-                'gdb_found': 0,
-                'skipped': False
-            }
+        if 'application/json' not in content_type and (
+                'text/html' in content_type or response.content.lstrip().startswith((b'<!DOCTYPE', b'<html'))):
+            raise FetchError(f"Received HTML response instead of JSON for state {state_name} ({state_code})")
         
+        # Valid JSON that is not an object (a list, null) is a failed response, not an empty state
         try:
-            data = response.json()
-        except json.JSONDecodeError as e:
-            # Save the response content for debugging
-            debug_file = f"debug_response_{state_code}.txt"
-            with open(debug_file, 'w', encoding='utf-8') as f:
-                f.write(response.text)
-            
-            error_msg = f"JSON decode error: {str(e)}. Response saved to {debug_file}"
-            print(error_msg)
-            
-            # Log failed request
-            cursor.execute('''
-                INSERT INTO nfhl_request_log (state_code, success, error_message, gdb_found)
-                VALUES (?, ?, ?, ?)
-            ''', (state_code, False, error_msg, 0))
-            
-            conn.commit()
+            data = loads_json_object(response.content)
+        except ValueError as e:
+            # Keep the start of the body for debugging; it is written to disk once, at exit
+            body = response.content[:DEBUG_RESPONSE_BYTES].decode('utf-8', errors='replace')
+            DEBUG_RESPONSES.append((state_code, datetime.now().isoformat(timespec='seconds'), body))
             
-            return {
-                'success': False,
-                'error': error_msg,
-                'gdb_found': 0,
-                'skipped': False
-            }
-        
-        # Extract EFFECTIVE items with NFHL_STATE_DATA
-        gdb_found = 0
-        if 'EFFECTIVE' in data and 'NFHL_STATE_DATA' in data['EFFECTIVE']:
-            for item in data['EFFECTIVE']['NFHL_STATE_DATA']:
-                if item.get('product_SUBTYPE_ID') == 'NFHL_STATE_DATA':
-                    # Insert GDB data
-                    cursor.execute('''
-                        INSERT INTO gdb_nfhl (
-                            state_code,
-                            product_id, product_type_id, product_subtype_id,
-                            product_name, product_description,
-                            product_effective_date, product_issue_date,
-                            product_effective_date_string, product_posting_date,
-                            product_posting_date_string, product_issue_date_string,
-                            product_effective_flag, product_file_path, product_file_size
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        state_code,
-                        item.get('product_ID'), item.get('product_TYPE_ID'), item.get('product_SUBTYPE_ID'),
-                        item.get('product_NAME'), item.get('product_DESCRIPTION'),
-                        item.get('product_EFFECTIVE_DATE'), item.get('product_ISSUE_DATE'),
-                        item.get('product_EFFECTIVE_DATE_STRING'), item.get('product_POSTING_DATE'),
-                        item.get('product_POSTING_DATE_STRING'), item.get('product_ISSUE_DATE_STRING'),
-                        item.get('product_EFFECTIVE_FLAG'), item.get('product_FILE_PATH'), item.get('product_FILE_SIZE')
-                    ))
-                    gdb_found += 1
+            raise FetchError(f"JSON decode error: {str(e)}. Response kept for {DEBUG_RESPONSES_FILE}") from e
         
-        # Log successful request
-        cursor.execute('''
-            INSERT INTO nfhl_request_log (state_code, success, gdb_found)
-            VALUES (?, ?, ?)
-        ''', (state_code, True, gdb_found))
+        # Only the EFFECTIVE section is used (and cached); the rest of the document is released right away
+        effective = data.get('EFFECTIVE')
+        return effective if isinstance(effective, dict) else {}
+    
+    try:
+        # Served from the checkpoint store when a recent run already fetched it; failures are never cached
+        effective = fetch_cache.get_or_fetch(
+            f"nfhl:{state_code}:{county_code}:{community_code}", request_effective,
+            FETCH_CACHE_PATH, max_age=RESPONSE_CACHE_MAX_AGE
+        )
         
-        conn.commit()
+        # Extract EFFECTIVE items with NFHL_STATE_DATA as ready-to-insert gdb_nfhl rows
+        rows = [
+            (state_code, *map(item.get, GDB_ITEM_KEYS))
+            for item in effective.get('NFHL_STATE_DATA', ())
+            if item.get('product_SUBTYPE_ID') == 'NFHL_STATE_DATA'
+        ]
         
         return {
             'success': True,
-            'gdb_found': gdb_found,
-            'skipped': False
+            'rows': rows,
+            'gdb_found': len(rows)
         }
         
+    except FetchError as e:
+        error_msg = str(e)
+        print(error_msg)
+        
+        return {
+            'success': False,
+            'error': error_msg,
+            'gdb_found': 0
+        }
     except requests.exceptions.RequestException as e:
         error_msg = str(e)
         print(f"Error fetching data for {state_name} ({state_code}): {error_msg}")
         
-        # Log failed request
-        cursor.execute('''
-            INSERT INTO nfhl_request_log (state_code, success, error_message, gdb_found)
-            VALUES (?, ?, ?, ?)
-        ''', (state_code, False, error_msg, 0))
-        
-        conn.commit()
-        
         return {
             'success': False,
             'error': error_msg,
-            'gdb_found': 0,
-            'skipped': False
+            'gdb_found': 0
         }
-    # JSON error handling has been moved inside the try block
+
+def store_nfhl_result(conn, state_code, result):
+    """Insert the GDB rows from a fetch result, log the request, and return the rows inserted.
+    
+    Does not commit; the caller commits whole states, so GDB rows and their log row land together.
+    """
+    cursor = conn.cursor()
+    
+    if not result['success']:
+        # Log failed request
+        cursor.execute(INSERT_LOG_FAIL_SQL, (state_code, result['error']))
+        return 0
+    
+    # Insert GDB data
+    cursor.executemany(INSERT_GDB_SQL, result['rows'])
+    gdb_found = cursor.rowcount
+    
+    # Log successful request
+    cursor.execute(INSERT_LOG_SUCCESS_SQL, (state_code, gdb_found))
+    return gdb_found
+
+class NFHLResultWriter(ResultWriter):
+    """Writer thread storing (state_code, result) pairs, committing every COMMIT_EVERY_STATES states."""
+    def __init__(self, db_path, maxsize=RESULT_QUEUE_SIZE):
+        super().__init__(lambda: connect_database(db_path), maxsize)
+        self.states_stored = 0
+    
+    def write(self, conn, item):
+        store_nfhl_result(conn, *item)
+        
+        # Commit on state boundaries only, so resume never sees half a state
+        self.states_stored += 1
+        if self.states_stored % COMMIT_EVERY_STATES == 0:
+            conn.commit()
+    
+    def flush(self, conn):
+        conn.commit()
 
 def get_processed_states(conn):
     """Get set of already processed states."""
     cursor = conn.cursor()
-    cursor.execute('SELECT state_code FROM nfhl_request_log WHERE success = 1')
-    return set(row[0] for row in cursor.fetchall())
+    cursor.execute('SELECT DISTINCT state_code FROM nfhl_request_log WHERE success = 1')
+    return {row[0] for row in cursor.fetchall()}
 
 def get_statistics(conn):
     """Get statistics from the database."""
     cursor = conn.cursor()
     
-    # Total counts
-    cursor.execute('SELECT COUNT(*) FROM nfhl_states')
-    total_states = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT COUNT(*) FROM gdb_nfhl')
-    total_gdb = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT COUNT(*) FROM nfhl_request_log WHERE success = 1')
-    successful_requests = cursor.fetchone()[0]
+    # Read everything from one snapshot
+    cursor.execute('BEGIN')
     
-    cursor.execute('SELECT COUNT(*) FROM nfhl_request_log WHERE success = 0')
-    failed_requests = cursor.fetchone()[0]
+    # Total counts; the request log is scanned once for both outcomes
+    cursor.execute('''
+        SELECT
+            (SELECT COUNT(*) FROM nfhl_states),
+            (SELECT COUNT(*) FROM gdb_nfhl),
+            COALESCE(SUM(success = 1), 0),
+            COALESCE(SUM(success = 0), 0)
+        FROM nfhl_request_log
+    ''')
+    total_states, total_gdb, successful_requests, failed_requests = cursor.fetchone()
     
     # Top states by GDB count
     cursor.execute('''
@@ -331,6 +408,8 @@ def get_statistics(conn):
     ''')
     top_states = cursor.fetchall()
     
+    conn.commit()
+    
     return {
         'total_states': total_states,
         'total_gdb': total_gdb,
@@ -385,30 +464,49 @@ def main():
     total_gdb_found = 0
     skipped_count = 0
     
-    # Process each state
+    # Skip if already processed
+    pending_states = []
     for state_code, state_info in communities_data['states'].items():
         state_name = state_info['state_name']
-        
-        # Skip if already processed
         if state_code in processed_states:
             print(f"Skipping already processed state: {state_name} ({state_code})")
             skipped_count += 1
-            continue
-        
-        print(f"\nProcessing state: {state_name} ({state_code})")
-        
-        # Fetch NFHL state GDB data
-        result = fetch_nfhl_state_data(conn, state_code, state_name, counties_data)
-        
-        # Update counters
-        if not result.get('skipped', False):
-            total_processed += 1
-            total_gdb_found += result['gdb_found']
         else:
-            skipped_count += 1
-        
-        # Rate limiting - wait between requests
-        time.sleep(0.5)
+            pending_states.append((state_code, state_name))
+    
+    print(f"\nFetching {len(pending_states)} states with up to {MAX_WORKERS} workers...")
+    
+    rate_limiter = RateLimiter(REQUESTS_PER_SECOND)
+    
+    # Results are stored by the writer thread's own connection; conn is only read from below
+    writer = NFHLResultWriter(db_path)
+    writer.start()
+    
+    # Fetch states concurrently; results are handed to the writer thread as they complete
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {
+                executor.submit(fetch_nfhl_state_data, state_code, state_name, counties_data, rate_limiter):
+                    (state_code, state_name)
+                for state_code, state_name in pending_states
+            }
+            
+            for future in as_completed(futures):
+                state_code, state_name = futures[future]
+                result = future.result()
+                writer.put((state_code, result))
+                if result['success']:
+                    print(f"Processed state: {state_name} ({state_code}) - {result['gdb_found']} GDB files")
+                
+                # Update counters
+                total_processed += 1
+                total_gdb_found += result['gdb_found']
+    finally:
+        # Let the writer store everything queued so far, even if the run is interrupted
+        writer.close()
+    
+    if writer.error is not None:
+        raise RuntimeError("Writing results to the database failed") from writer.error
     
     # Get final statistics
     stats = get_statistics(conn)
@@ -10,6 +10,7 @@ This script:
 5. Resumes interrupted downloads (skips already downloaded files)
 6. Uses configuration file for settings
 7. Supports limiting downloads for testing (--limit option)
+8. Downloads several files at once (download.max_workers in the config)
 
 Usage:
     python notebooks/05_download_nfhl_gdb.py                    # Download all
@@ -20,15 +21,59 @@ Usage:
 import sqlite3
 import requests
 import os
-import time
+import threading
 import json
 import argparse
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from urllib.parse import urljoin
 import hashlib
+import re
 
+from fema_utils import (DEFAULT_MAX_WORKERS, DEFAULT_MAX_WORKERS_CAP, PENDING_DOWNLOADS_PER_WORKER,
+                        WORKER_STACK_SIZE, LogBuffer, ProgressWriter, create_rate_limiter, create_session,
+                        drop_page_cache, get_max_workers, preallocate_file, probe_remote, save_response_body,
+                        submit_bounded)
+
+# SQLite tuning applied on connect; WAL lets log commits append instead of rewriting the
+# database file. Entries under database.pragmas in the config override these.
+DEFAULT_DB_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "cache_size": -65536,
+    "mmap_size": 268435456
+}
+
+# Bytes before the resume point compared against the server before appending to a partial file
+RESUME_CHECK_BYTES = 4096
+
+# Rough sustained write rate of one download stream, used to turn download.disk_bandwidth_mb_s
+# into the number of workers allowed to write to disk at the same time
+STREAM_WRITE_MB_S = 25
+
+# Files smaller than this are always fetched over a single connection, even with download.parts_per_file
+MULTIPART_MIN_SIZE = 64 * 1024 * 1024
+
+# Rounds in which the failed byte ranges of a multipart download are requested again before it gives up
+MULTIPART_ATTEMPTS = 3
+
+# Product sizes in the database look like '248MB' or '1.2 GB'; the unit maps to a power of 1024
+SIZE_PATTERN = re.compile(r'^\s*([\d.]+)\s*([KMGT]?B)?\s*$', re.IGNORECASE)
+SIZE_UNIT_SHIFTS = {'B': 0, 'KB': 10, 'MB': 20, 'GB': 30, 'TB': 40}
+
+INSERT_LOG_SQL = '''
+    INSERT INTO nfhl_download_log 
+    (state_code, product_name, product_file_path, 
+     download_success, file_path, file_size_bytes, error_message,
+     remote_etag, remote_last_modified)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+@functools.lru_cache(maxsize=4)
 def load_config(config_path='config.json'):
-    """Load configuration from JSON file."""
+    """Load configuration from JSON file; each path is read once per process."""
     if not os.path.exists(config_path):
         # Create default config if it doesn't exist
         default_config = {
@@ -36,12 +81,18 @@ def load_config(config_path='config.json'):
                 "base_path": "E:\\FEMA_DOWNLOAD",
                 "nfhl_base_path": "E:\\FEMA_NFHL_DOWNLOAD",
                 "rate_limit_seconds": 0.2,
-                "chunk_size_bytes": 8192,
-                "timeout_seconds": 30
+                "requests_per_second": 5,
+                "parts_per_file": 1,
+                "disk_bandwidth_mb_s": 0,
+                "chunk_size_bytes": 1048576,
+                "timeout_seconds": 30,
+                "max_workers": DEFAULT_MAX_WORKERS,
+                "max_workers_cap": DEFAULT_MAX_WORKERS_CAP
             },
             "database": {
                 "path": "meta_results/flood_risk_shapefiles.db",
-                "nfhl_path": "meta_results/flood_risk_nfhl_gdb.db"
+                "nfhl_path": "meta_results/flood_risk_nfhl_gdb.db",
+                "pragmas": DEFAULT_DB_PRAGMAS
             },
             "api": {
                 "base_url": "https://msc.fema.gov",
@@ -64,8 +115,8 @@ def load_config(config_path='config.json'):
     except Exception as e:
         raise ValueError(f"Error reading config file {config_path}: {e}")
 
-def connect_database(db_path):
-    """Connect to the SQLite database."""
+def connect_database(db_path, pragmas=None):
+    """Connect to the SQLite database and apply DEFAULT_DB_PRAGMAS plus any overrides."""
     # Print absolute path for debugging
     abs_path = os.path.abspath(db_path)
     print(f"Attempting to connect to database at: {abs_path}")
@@ -79,7 +130,13 @@ def connect_database(db_path):
     
     # Connect with more verbose error handling
     try:
-        conn = sqlite3.connect(db_path)
+        # Autocommit mode: multi-statement writes open their own transactions explicitly
+        conn = sqlite3.connect(db_path, cached_statements=256, isolation_level=None)
+        
+        pragmas = {**DEFAULT_DB_PRAGMAS, **(pragmas or {})}
+        conn.executescript(''.join(f"PRAGMA {name}={value};" for name, value in pragmas.items()))
+        journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        print(f"Journal mode: {journal_mode}")
         
         # Test if we can access the database
         cursor = conn.cursor()
@@ -97,11 +154,11 @@ def connect_database(db_path):
         print(f"SQLite error during connection: {e}")
         raise
 
-def get_gdb_files_to_download(conn):
-    """Get all NFHL GDB files from database that need to be downloaded."""
+def get_gdb_files_to_download(conn, limit=None):
+    """Get a cursor over the NFHL GDB files that have no successful download logged, at most limit of them."""
     cursor = conn.cursor()
     
-    # Query for the gdb_nfhl and nfhl_states tables
+    # Anti-join against the download log so only the remaining files leave SQLite
     query = '''
         SELECT DISTINCT
             g.state_code,
@@ -111,17 +168,21 @@ def get_gdb_files_to_download(conn):
             s.state_name
         FROM gdb_nfhl g
         JOIN nfhl_states s ON g.state_code = s.state_code
+        LEFT JOIN (
+            SELECT product_name FROM nfhl_download_log WHERE download_success = 1
+        ) l ON l.product_name = g.product_name
         WHERE g.product_file_path IS NOT NULL
+          AND l.product_name IS NULL
         ORDER BY g.state_code
+        LIMIT ?
     '''
     
     print(f"Executing query: {query}")
     
     try:
-        cursor.execute(query)
-        results = cursor.fetchall()
-        print(f"Query returned {len(results)} results")
-        return results
+        # A negative LIMIT means no limit in SQLite
+        cursor.execute(query, (limit or -1,))
+        return cursor
     except sqlite3.Error as e:
         print(f"SQLite error during query execution: {e}")
         print("Attempting to check if tables exist...")
@@ -166,56 +227,188 @@ def get_file_hash(filepath):
     except Exception:
         return None
 
-def download_file(url, filepath, expected_size=None, config=None):
-    """Download a file with progress tracking and resume capability."""
-    if config is None:
-        config = load_config()
-    
-    headers = {
-        'User-Agent': config['api']['user_agent']
-    }
+def resume_tail_matches(session, url, filepath, resume_pos, timeout):
+    """Check that the last RESUME_CHECK_BYTES of a partial file match the same range on the server."""
+    start = resume_pos - RESUME_CHECK_BYTES
+    with session.get(url, headers={'Range': f'bytes={start}-{resume_pos - 1}'}, timeout=timeout) as response:
+        # A server that ignores the range cannot resume anyway
+        if response.status_code != 206:
+            return False
+        remote_tail = response.content
+    
+    with open(filepath, 'rb') as f:
+        f.seek(start)
+        return f.read(RESUME_CHECK_BYTES) == remote_tail
+
+def download_file_multipart(url, filepath, total_size, parts, config, session, rate_limiter=None,
+                            write_slots=None):
+    """Download a file as parts byte ranges fetched in parallel, each written at its own offset.
+    
+    The ranges are written into a preallocated filepath + '.part', which replaces filepath only once
+    every range has arrived, so an interrupted run never leaves a file with holes under the real name.
+    A range that fails is requested again from the byte it stopped at, in up to MULTIPART_ATTEMPTS
+    rounds. If some still fail, the .part is cut back to the bytes received without a gap from its
+    start, which download_file resumes over a single connection on the next run.
+    """
+    part_size = -(-total_size // parts)
+    ranges = [(start, min(start + part_size, total_size)) for start in range(0, total_size, part_size)]
+    part_path = filepath + '.part'
+    chunk_size = config['download']['chunk_size_bytes']
+    
+    # Bytes written so far at the start of each range; each entry is only updated by the thread fetching it
+    received = [0] * len(ranges)
+    progress = ProgressWriter(None, filepath, 0, total_size, write_slots)
+    
+    with open(part_path, 'wb') as f:
+        preallocate_file(f.fileno(), total_size)
+        f.truncate(total_size)
+    
+    def fetch_range(index):
+        start, end = ranges[index]
+        offset = start + received[index]
+        if rate_limiter:
+            rate_limiter.acquire()
+        headers = {'Range': f'bytes={offset}-{end - 1}'}
+        with session.get(url, headers=headers, stream=True, timeout=config['download']['timeout_seconds']) as response:
+            if response.status_code != 206:
+                raise requests.exceptions.HTTPError(f"Range {offset}-{end - 1} returned HTTP {response.status_code}")
+            
+            # Separate handles per range, so no seek position is shared between threads
+            with open(part_path, 'r+b') as f:
+                f.seek(offset)
+                response.raw.decode_content = True
+                try:
+                    for block in iter(functools.partial(response.raw.read, chunk_size), b''):
+                        progress.write_to(f, block)
+                        received[index] += len(block)
+                finally:
+                    f.flush()
+                    drop_page_cache(f.fileno())
+        if start + received[index] != end:
+            raise requests.exceptions.ConnectionError(f"Range {start}-{end - 1} ended after {received[index]} bytes")
+    
+    def received_prefix():
+        """Bytes present without a gap from the start of the file."""
+        for (start, end), count in zip(ranges, received):
+            if start + count < end:
+                return start + count
+        return total_size
+    
+    missing = list(range(len(ranges)))
+    try:
+        for attempt in range(1, MULTIPART_ATTEMPTS + 1):
+            with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+                futures = {index: executor.submit(fetch_range, index) for index in missing}
+            
+            errors = []
+            for index, future in futures.items():
+                try:
+                    future.result()
+                except requests.exceptions.RequestException as e:
+                    # A range can fail after its last byte arrived; only the ones still short are fetched again
+                    start, end = ranges[index]
+                    if start + received[index] < end:
+                        errors.append((index, e))
+            if not errors:
+                break
+            
+            missing = [index for index, _ in errors]
+            if attempt == MULTIPART_ATTEMPTS:
+                raise errors[0][1]
+            print(f"    {len(missing)} of {len(ranges)} ranges of {os.path.basename(filepath)} failed "
+                  f"({errors[0][1]}); resuming them")
+    except BaseException:
+        # Keep the bytes received up to the first gap, so the next run does not fetch them again
+        with open(part_path, 'r+b') as f:
+            f.truncate(received_prefix())
+        raise
     
-    # Check if file already exists and get its size
-    resume_pos = 0
+    os.replace(part_path, filepath)
+    print(f"    ✓ Downloaded: {os.path.basename(filepath)} ({total_size // (1024*1024)}MB in {len(ranges)} parts)")
+    return True
+
+def download_file(url, filepath, config, expected_size=None, session=None, rate_limiter=None, remote=None,
+                  write_slots=None, logged_last_modified=None):
+    """Download a file with progress tracking and resume capability.
+    
+    remote is the (size, etag, last_modified, accepts_ranges) tuple from probe_remote; its exact size
+    takes precedence over expected_size, which comes from the rounded size string in the database.
+    write_slots, if given, is a semaphore bounding how many downloads write to disk at once.
+    logged_last_modified is the Last-Modified the server reported when an earlier run failed on this
+    file; if the server now reports a different one, the partial file is from an older copy.
+    
+    Data is written to filepath + '.part', which replaces filepath once the download has finished,
+    so a crash can never leave a preallocated, partly zero file under the real name.
+    """
+    if session is None:
+        session = create_session({'User-Agent': config['api']['user_agent']}, retries=5)
+    remote_size, _, remote_last_modified, accepts_ranges = remote or (None, None, None, False)
+    part_path = filepath + '.part'
+    
+    headers = {}
+    
+    # Check if file already exists and is complete
     if os.path.exists(filepath):
-        resume_pos = os.path.getsize(filepath)
-        if expected_size and resume_pos >= expected_size:
+        file_size = os.path.getsize(filepath)
+        if remote_size:
+            if file_size == remote_size:
+                print(f"    File already complete: {os.path.basename(filepath)}")
+                return True
+        elif expected_size and file_size >= expected_size:
             print(f"    File already complete: {os.path.basename(filepath)}")
             return True
-        headers['Range'] = f'bytes={resume_pos}-'
+        # Left partial under the real name by an older version of this script; resume it as the .part
+        os.replace(filepath, part_path)
+    
+    # Resume from the bytes an earlier run left in the .part file
+    resume_pos = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if resume_pos and remote_size and resume_pos >= remote_size:
+        # As long as the server copy: preallocated by a run that was killed
+        resume_pos = 0
+    if resume_pos and logged_last_modified and remote_last_modified and remote_last_modified != logged_last_modified:
+        # The server copy changed since the run that wrote the partial file
+        resume_pos = 0
     
     try:
-        response = requests.get(url, headers=headers, stream=True, timeout=config['download']['timeout_seconds'])
-        
-        # Handle range request responses
-        if response.status_code == 206:  # Partial content
-            mode = 'ab'
-        elif response.status_code == 200:  # Full content
-            mode = 'wb'
-            resume_pos = 0
-        else:
-            response.raise_for_status()
+        # Large fresh downloads can be split across connections when the server supports ranges
+        parts = config['download'].get('parts_per_file', 1)
+        if parts > 1 and resume_pos == 0 and accepts_ranges and remote_size and remote_size >= MULTIPART_MIN_SIZE:
+            return download_file_multipart(url, filepath, remote_size, parts, config, session, rate_limiter,
+                                           write_slots)
         
-        total_size = int(response.headers.get('content-length', 0)) + resume_pos
+        if resume_pos > RESUME_CHECK_BYTES:
+            if rate_limiter:
+                rate_limiter.acquire()
+            if not resume_tail_matches(session, url, part_path, resume_pos, config['download']['timeout_seconds']):
+                # Appending to a partial file that differs from the server copy would produce a corrupt ZIP
+                print(f"    Partial file does not match the server copy, restarting: {os.path.basename(filepath)}")
+                resume_pos = 0
+        if resume_pos:
+            headers['Range'] = f'bytes={resume_pos}-'
         
-        with open(filepath, mode) as f:
-            downloaded = resume_pos
-            last_progress_mb = downloaded // (1024 * 1024)
+        if rate_limiter:
+            rate_limiter.acquire()
+        with session.get(url, headers=headers, stream=True, timeout=config['download']['timeout_seconds']) as response:
+            # Handle range request responses
+            if response.status_code == 206:  # Partial content
+                mode = 'ab'
+            elif response.status_code == 200:  # Full content
+                mode = 'wb'
+                resume_pos = 0
+            else:
+                response.raise_for_status()
+            
+            total_size = int(response.headers.get('content-length', 0)) + resume_pos
             
-            for chunk in response.iter_content(chunk_size=config['download']['chunk_size_bytes']):
-                if chunk:
-                    f.write(chunk)
-                    downloaded += len(chunk)
-                    
-                    # Progress update every 10MB to reduce spam
-                    current_mb = downloaded // (1024 * 1024)
-                    if current_mb >= last_progress_mb + 10:  # Every 10MB
-                        if total_size > 0:
-                            percent = (downloaded / total_size) * 100
-                            print(f"    Progress: {current_mb}MB / {total_size // (1024*1024)}MB ({percent:.1f}%)")
-                        last_progress_mb = current_mb
+            with open(part_path, mode) as f:
+                writer = ProgressWriter(f, filepath, resume_pos, total_size, write_slots)
+                if mode == 'wb' and total_size > 0:
+                    preallocate_file(f.fileno(), total_size)
+                
+                save_response_body(response, writer, config['download']['chunk_size_bytes'])
         
-        print(f"    ✓ Downloaded: {os.path.basename(filepath)} ({downloaded // (1024*1024)}MB)")
+        os.replace(part_path, filepath)
+        print(f"    ✓ Downloaded: {os.path.basename(filepath)} ({writer.downloaded // (1024*1024)}MB)")
         return True
         
     except requests.exceptions.RequestException as e:
@@ -228,6 +421,7 @@ def download_file(url, filepath, expected_size=None, config=None):
 def create_download_log_table(conn):
     """Create table to track download progress."""
     cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS nfhl_download_log (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -238,50 +432,128 @@ def create_download_log_table(conn):
             download_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             file_path TEXT,
             file_size_bytes INTEGER,
-            error_message TEXT
+            error_message TEXT,
+            remote_etag TEXT,
+            remote_last_modified TEXT
         )
     ''')
     
+    # Logs created before the HEAD probe existed lack its columns
+    existing_columns = {column[1] for column in cursor.execute('PRAGMA table_info(nfhl_download_log)')}
+    for column_name, column_type in (('remote_etag', 'TEXT'), ('remote_last_modified', 'TEXT')):
+        if column_name not in existing_columns:
+            cursor.execute(f'ALTER TABLE nfhl_download_log ADD COLUMN {column_name} {column_type}')
+    
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_nfhl_download_log_product ON nfhl_download_log (product_name)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_nfhl_download_log_success ON nfhl_download_log (download_success)')
-    conn.commit()
+    # Covers the successful-download lookups, so they never touch the table rows;
+    # it also replaces the single-column index on download_success
+    cursor.execute('DROP INDEX IF EXISTS idx_nfhl_download_log_success')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_nfhl_download_log_success_product ON nfhl_download_log (download_success, product_name)')
+    cursor.execute('COMMIT')
+
+class DownloadLogBuffer(LogBuffer):
+    """Download results queued for nfhl_download_log."""
+    def __init__(self, conn):
+        super().__init__(conn, INSERT_LOG_SQL)
+    
+    def log_download_result(self, state_code, product_name, product_file_path,
+                            success, file_path=None, file_size=None, error_msg=None,
+                            remote_etag=None, remote_last_modified=None):
+        """Queue a download result, writing the batch once it reaches flush_size rows."""
+        self.add((state_code, product_name, product_file_path,
+                  success, file_path, file_size, error_msg,
+                  remote_etag, remote_last_modified))
 
-def log_download_result(conn, state_code, product_name, product_file_path, 
-                       success, file_path=None, file_size=None, error_msg=None):
-    """Log download result to database."""
+def get_file_counts(conn):
+    """Count the NFHL GDB files in the database and how many of them were already downloaded successfully."""
     cursor = conn.cursor()
     cursor.execute('''
-        INSERT INTO nfhl_download_log 
-        (state_code, product_name, product_file_path, 
-         download_success, file_path, file_size_bytes, error_message)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (state_code, product_name, product_file_path,
-          success, file_path, file_size, error_msg))
-    conn.commit()
+        SELECT COUNT(*), COUNT(l.product_name)
+        FROM (
+            SELECT DISTINCT g.state_code, g.product_name
+            FROM gdb_nfhl g
+            JOIN nfhl_states s ON g.state_code = s.state_code
+            WHERE g.product_file_path IS NOT NULL
+        ) g
+        LEFT JOIN (
+            SELECT DISTINCT product_name FROM nfhl_download_log WHERE download_success = 1
+        ) l ON l.product_name = g.product_name
+    ''')
+    return cursor.fetchone()
 
-def get_downloaded_files(conn):
-    """Get set of already successfully downloaded files."""
+def get_logged_last_modified(conn):
+    """Map each product with a failed download logged to the Last-Modified the server reported for it then."""
     cursor = conn.cursor()
-    cursor.execute('SELECT product_name FROM nfhl_download_log WHERE download_success = 1')
-    return set(row[0] for row in cursor.fetchall())
+    # Rows are read oldest first, so the latest failure of each product wins
+    cursor.execute('''
+        SELECT product_name, remote_last_modified
+        FROM nfhl_download_log
+        WHERE download_success = 0 AND remote_last_modified IS NOT NULL
+        ORDER BY id
+    ''')
+    return dict(cursor)
 
 def parse_file_size(size_str):
     """Parse file size string like '248MB' to bytes."""
     if not size_str:
         return None
     
-    size_str = size_str.upper().strip()
-    if size_str.endswith('MB'):
-        return int(float(size_str[:-2]) * 1024 * 1024)
-    elif size_str.endswith('KB'):
-        return int(float(size_str[:-2]) * 1024)
-    elif size_str.endswith('GB'):
-        return int(float(size_str[:-2]) * 1024 * 1024 * 1024)
-    else:
-        try:
-            return int(size_str)
-        except:
-            return None
+    match = SIZE_PATTERN.match(size_str)
+    if not match:
+        return None
+    
+    try:
+        # Scale before truncating, so fractional sizes like '1.5GB' keep their fraction
+        return int(float(match.group(1)) * (1 << SIZE_UNIT_SHIFTS[(match.group(2) or 'B').upper()]))
+    except ValueError:
+        return None
+
+def get_disk_write_slots(config):
+    """Create the semaphore bounding concurrent disk writes from download.disk_bandwidth_mb_s (0 means no bound)."""
+    disk_bandwidth_mb_s = config['download'].get('disk_bandwidth_mb_s', 0)
+    if disk_bandwidth_mb_s <= 0:
+        return None
+    max_disk_writers = max(1, int(disk_bandwidth_mb_s // STREAM_WRITE_MB_S))
+    print(f"Disk writes limited to {max_disk_writers} at a time ({disk_bandwidth_mb_s} MB/s budget)")
+    return threading.BoundedSemaphore(max_disk_writers)
+
+def download_gdb_file(gdb_file, download_base_path, config, session, rate_limiter, write_slots,
+                      logged_last_modified=None):
+    """Download one GDB file; runs in a worker thread and returns (filepath, success, actual_size, remote)."""
+    (state_code, product_name, product_file_path, product_file_size, state_name) = gdb_file
+    
+    # The state folder was created by main before this file was queued
+    download_folder = os.path.join(download_base_path, state_code)
+    
+    # Determine filename
+    filename = f"{product_name}.zip"
+    filepath = os.path.join(download_folder, filename)
+    
+    # Get download URL
+    download_url = get_download_url(product_name)
+    
+    # Parse expected file size
+    expected_size = parse_file_size(product_file_size)
+    
+    # A file at least as large as the database size is complete; no request needed
+    if expected_size and os.path.exists(filepath) and os.path.getsize(filepath) >= expected_size:
+        print(f"    File already complete: {filename}")
+        return filepath, True, os.path.getsize(filepath), None
+    
+    # Ask the server for the exact size and version; without it, fall back to the parsed size
+    try:
+        remote = probe_remote(session, download_url, config['download']['timeout_seconds'], rate_limiter)
+    except requests.exceptions.RequestException as e:
+        print(f"    HEAD request failed, using the database size: {e}")
+        remote = None
+    
+    # Download file
+    success = download_file(download_url, filepath, config, expected_size, session, rate_limiter, remote,
+                            write_slots, logged_last_modified)
+    
+    # Get actual file size
+    actual_size = os.path.getsize(filepath) if success and os.path.exists(filepath) else 0
+    return filepath, success, actual_size, remote
 
 def main():
     """Main function to download all NFHL GDB files."""
@@ -315,7 +587,7 @@ def main():
     
     # Connect to database
     try:
-        conn = connect_database(db_path)
+        conn = connect_database(db_path, config['database'].get('pragmas'))
         create_download_log_table(conn)
     except FileNotFoundError as e:
         print(f"Error: {e}")
@@ -333,9 +605,10 @@ def main():
             print(f"Database error: {e}")
         return
     
-    # Get GDB files to download
-    gdb_files = get_gdb_files_to_download(conn)
-    total_files = len(gdb_files)
+    # Get GDB files to download; already downloaded files are filtered out by the query
+    files_to_download = get_gdb_files_to_download(conn, args.limit)
+    total_files, downloaded_files_count = get_file_counts(conn)
+    logged_last_modified = get_logged_last_modified(conn)
     
     if total_files == 0:
         print("No NFHL GDB files found in database.")
@@ -345,93 +618,101 @@ def main():
     print(f"Download location: {download_base_path}")
     print("=" * 60)
     
-    # Get already downloaded files
-    downloaded_files = get_downloaded_files(conn)
-    
-    # Filter out already downloaded files
-    files_to_download = []
-    for gdb_file in gdb_files:
-        product_name = gdb_file[1]  # product_name is at index 1
-        if product_name not in downloaded_files:
-            files_to_download.append(gdb_file)
-    
-    print(f"Files already downloaded: {len(downloaded_files)}")
-    print(f"Files remaining to download: {len(files_to_download)}")
+    print(f"Files already downloaded: {downloaded_files_count}")
+    remaining_files = total_files - downloaded_files_count
+    print(f"Files remaining to download: {remaining_files}")
     
-    # Apply limit if specified
-    if args.limit and len(files_to_download) > args.limit:
-        files_to_download = files_to_download[:args.limit]
+    if args.limit:
         print(f"Limited to first {args.limit} files for testing")
+        remaining_files = min(remaining_files, args.limit)
     
-    print(f"Will download {len(files_to_download)} files")
+    print(f"Will download {remaining_files} files")
     print("=" * 60)
     
     # Create base download directory
     os.makedirs(download_base_path, exist_ok=True)
     
     # Download statistics
+    processed_count = 0
     downloaded_count = 0
     failed_count = 0
     skipped_count = 0
     total_size_downloaded = 0
     
-    # Process each GDB file
-    for i, gdb_file in enumerate(files_to_download, 1):
-        (state_code, product_name, product_file_path, product_file_size, state_name) = gdb_file
-        
-        print(f"\n[{i}/{len(files_to_download)}] Processing: {product_name}")
-        print(f"  State: {state_name} ({state_code})")
-        print(f"  Size: {product_file_size}")
-        
-        # Create download folder
-        download_folder = create_download_folder(download_base_path, state_code)
-        
-        # Determine filename
-        filename = f"{product_name}.zip"
-        filepath = os.path.join(download_folder, filename)
-        
-        # Get download URL
-        download_url = get_download_url(product_name)
-        print(f"  URL: {download_url}")
-        
-        # Parse expected file size
-        expected_size = parse_file_size(product_file_size)
-        
-        # Download file
-        success = download_file(download_url, filepath, expected_size, config)
-        
-        if success:
-            # Get actual file size
-            actual_size = os.path.getsize(filepath) if os.path.exists(filepath) else 0
-            total_size_downloaded += actual_size
-            downloaded_count += 1
-            
-            # Log success
-            log_download_result(conn, state_code, product_name, product_file_path, 
-                              True, filepath, actual_size)
-        else:
-            failed_count += 1
-            # Log failure
-            log_download_result(conn, state_code, product_name, product_file_path,
-                              False, error_msg="Download failed")
-        
-        # Progress summary
-        if i % 10 == 0 or i == len(files_to_download):
-            print(f"\n  Progress Summary: {i}/{len(files_to_download)} processed")
-            print(f"    Downloaded: {downloaded_count}")
-            print(f"    Failed: {failed_count}")
-            print(f"    Total size: {total_size_downloaded // (1024*1024)}MB")
-        
-        # Rate limiting
-        time.sleep(config['download']['rate_limit_seconds'])
+    max_workers = get_max_workers(config)
+    print(f"Downloading with {max_workers} parallel workers")
     
+    # Pooled connections for every worker's range requests, not just one per worker
+    session = create_session({'User-Agent': config['api']['user_agent']},
+                             max_workers * max(1, config['download'].get('parts_per_file', 1)), retries=5)
+    rate_limiter = create_rate_limiter(config)
+    write_slots = get_disk_write_slots(config)
+    
+    # Download in parallel; results are logged on this thread, which owns the database connection
+    default_stack_size = threading.stack_size(WORKER_STACK_SIZE)
+    try:
+        with DownloadLogBuffer(conn) as log_buffer, ThreadPoolExecutor(max_workers=max_workers) as executor:
+            state_folders = set()
+            
+            def queue_download(gdb_file):
+                (state_code, product_name, product_file_path, product_file_size, state_name) = gdb_file
+                
+                # Rows arrive ordered by state, so each state folder is created once, not once per file
+                if state_code not in state_folders:
+                    create_download_folder(download_base_path, state_code)
+                    state_folders.add(state_code)
+                
+                print(f"\nQueued: {product_name}")
+                print(f"  State: {state_name} ({state_code})")
+                print(f"  Size: {product_file_size}")
+                print(f"  URL: {get_download_url(product_name)}")
+                
+                return executor.submit(download_gdb_file, gdb_file, download_base_path, config,
+                                       session, rate_limiter, write_slots,
+                                       logged_last_modified.get(product_name))
+            
+            completed = submit_bounded(queue_download, files_to_download,
+                                       max_workers * PENDING_DOWNLOADS_PER_WORKER)
+            for gdb_file, future in completed:
+                (state_code, product_name, product_file_path, product_file_size, state_name) = gdb_file
+                filepath, success, actual_size, remote = future.result()
+                processed_count += 1
+                remote_etag, remote_last_modified = remote[1:3] if remote else (None, None)
+            
+                if success:
+                    total_size_downloaded += actual_size
+                    downloaded_count += 1
+                
+                    # Log success
+                    log_buffer.log_download_result(state_code, product_name, product_file_path,
+                                                   True, filepath, actual_size,
+                                                   remote_etag=remote_etag,
+                                                   remote_last_modified=remote_last_modified)
+                else:
+                    failed_count += 1
+                    # Log failure
+                    log_buffer.log_download_result(state_code, product_name, product_file_path,
+                                                   False, error_msg="Download failed",
+                                                   remote_etag=remote_etag,
+                                                   remote_last_modified=remote_last_modified)
+            
+                # Progress summary
+                if processed_count % 10 == 0 or processed_count == remaining_files:
+                    print(f"\n  Progress Summary: {processed_count}/{remaining_files} processed")
+                    print(f"    Downloaded: {downloaded_count}")
+                    print(f"    Failed: {failed_count}")
+                    print(f"    Total size: {total_size_downloaded // (1024*1024)}MB")
+    finally:
+        session.close()
+        threading.stack_size(default_stack_size)
+
     # Final summary
     print("\n" + "=" * 60)
     print("DOWNLOAD PROCESS COMPLETE")
     print("=" * 60)
     print(f"Total files in database: {total_files}")
-    print(f"Files already downloaded: {len(downloaded_files)}")
-    print(f"Files processed this run: {len(files_to_download)}")
+    print(f"Files already downloaded: {downloaded_files_count}")
+    print(f"Files processed this run: {processed_count}")
     print(f"Successfully downloaded: {downloaded_count}")
     print(f"Failed downloads: {failed_count}")
     print(f"Total data downloaded: {total_size_downloaded // (1024*1024)}MB")
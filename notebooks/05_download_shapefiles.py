@@ -10,6 +10,7 @@ This script:
 5. Resumes interrupted downloads (skips already downloaded files)
 6. Uses configuration file for settings
 7. Supports limiting downloads for testing (--limit option)
+8. Downloads several files at once (download.max_workers in the config)
 
 Usage:
     python notebooks/05_download_shapefiles.py                    # Download all
@@ -20,13 +21,36 @@ Usage:
 import sqlite3
 import requests
 import os
-import time
+import threading
 import json
 import argparse
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from urllib.parse import urljoin
 import hashlib
 
+from fema_utils import (DEFAULT_MAX_WORKERS, DEFAULT_MAX_WORKERS_CAP, PENDING_DOWNLOADS_PER_WORKER,
+                        WORKER_STACK_SIZE, LogBuffer, ProgressWriter, create_rate_limiter, create_session,
+                        enable_wal, get_max_workers, preallocate_file, probe_remote, save_response_body,
+                        submit_bounded)
+
+# Indexes serving get_shapefiles_to_download. 04_get_flood_risk_shapefiles.py drops its own secondary
+# indexes while crawling, so these do not rely on them; states, counties and communities are keyed by
+# their code already.
+SHAPEFILE_INDEXES = {
+    # Partial covering index: group by product without a temp B-tree, skipping rows without a file path
+    'idx_shapefiles_download_product': '''shapefiles (product_name, community_code, state_code, county_code,
+        product_file_path, product_file_size) WHERE product_file_path IS NOT NULL''',
+}
+
+INSERT_LOG_SQL = '''
+    INSERT INTO download_log 
+    (state_code, county_code, community_code, product_name, product_file_path, 
+     download_success, file_path, file_size_bytes, error_message)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
 def load_config(config_path='config.json'):
     """Load configuration from JSON file."""
     if not os.path.exists(config_path):
@@ -35,8 +59,11 @@ def load_config(config_path='config.json'):
             "download": {
                 "base_path": "E:\\FEMA_DOWNLOAD",
                 "rate_limit_seconds": 0.2,
-                "chunk_size_bytes": 8192,
-                "timeout_seconds": 30
+                "chunk_size_bytes": 1048576,
+                "timeout_seconds": 30,
+                "requests_per_second": 5,
+                "max_workers": DEFAULT_MAX_WORKERS,
+                "max_workers_cap": DEFAULT_MAX_WORKERS_CAP
             },
             "database": {
                 "path": "meta_results/flood_risk_shapefiles.db"
@@ -67,18 +94,25 @@ def connect_database(db_path):
     if not os.path.exists(db_path):
         raise FileNotFoundError(f"Database not found: {db_path}")
     
-    conn = sqlite3.connect(db_path)
+    # Autocommit mode; the log writes open their own transactions explicitly
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    
+    enable_wal(conn)
     return conn
 
-def get_shapefiles_to_download(conn):
-    """Get all shapefiles from database that need to be downloaded."""
+def get_shapefiles_to_download(conn, limit=None):
+    """Get a cursor over the shapefiles that have no successful download logged, at most limit of them."""
     cursor = conn.cursor()
     
+    # Anti-join against the download log so only the remaining files leave SQLite;
+    # a negative LIMIT means no limit. A product listed for several communities is
+    # one file, so group by product; the other columns come from the row with the
+    # lowest community_code.
     cursor.execute('''
-        SELECT DISTINCT 
+        SELECT
             sf.state_code,
             sf.county_code,
-            sf.community_code,
+            MIN(sf.community_code) AS community_code,
             sf.product_name,
             sf.product_file_path,
             sf.product_file_size,
@@ -89,11 +123,15 @@ def get_shapefiles_to_download(conn):
         JOIN states s ON sf.state_code = s.state_code
         JOIN counties c ON sf.county_code = c.county_code
         JOIN communities cm ON sf.community_code = cm.community_code
+        LEFT JOIN download_log dl ON dl.product_name = sf.product_name AND dl.download_success = 1
         WHERE sf.product_file_path IS NOT NULL
-        ORDER BY sf.state_code, sf.county_code, sf.community_code
-    ''')
+          AND dl.product_name IS NULL
+        GROUP BY sf.product_name
+        ORDER BY sf.state_code, sf.county_code, community_code
+        LIMIT ?
+    ''', (limit or -1,))
     
-    return cursor.fetchall()
+    return cursor
 
 def create_download_folder(base_path, state_code, county_code):
     """Create folder structure for downloads."""
@@ -101,6 +139,13 @@ def create_download_folder(base_path, state_code, county_code):
     os.makedirs(folder_path, exist_ok=True)
     return folder_path
 
+def stat_or_none(path):
+    """Return os.stat(path), or None if the file does not exist, in one system call."""
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
 def get_download_url(product_name):
     """Construct the full download URL using the correct FEMA format."""
     base_url = "https://msc.fema.gov/portal/downloadProduct"
@@ -117,56 +162,77 @@ def get_file_hash(filepath):
     except Exception:
         return None
 
-def download_file(url, filepath, expected_size=None, config=None):
-    """Download a file with progress tracking and resume capability."""
+def download_file(url, filepath, expected_size=None, config=None, session=None, rate_limiter=None):
+    """Download a file with progress tracking and resume capability.
+    
+    Data is written to filepath + '.part', which replaces filepath once the download has finished,
+    so a crash can never leave a preallocated, partly zero file under the real name.
+    """
     if config is None:
         config = load_config()
+    if session is None:
+        session = create_session({'User-Agent': config['api']['user_agent']})
+    part_path = filepath + '.part'
     
-    headers = {
-        'User-Agent': config['api']['user_agent']
-    }
-    
-    # Check if file already exists and get its size
-    resume_pos = 0
-    if os.path.exists(filepath):
-        resume_pos = os.path.getsize(filepath)
-        if expected_size and resume_pos >= expected_size:
-            print(f"    File already complete: {os.path.basename(filepath)}")
-            return True
-        headers['Range'] = f'bytes={resume_pos}-'
+    headers = {}
     
     try:
-        response = requests.get(url, headers=headers, stream=True, timeout=config['download']['timeout_seconds'])
-        
-        # Handle range request responses
-        if response.status_code == 206:  # Partial content
-            mode = 'ab'
-        elif response.status_code == 200:  # Full content
-            mode = 'wb'
-            resume_pos = 0
-        else:
-            response.raise_for_status()
+        # Check if file already exists and is complete
+        file_stat = stat_or_none(filepath)
+        if file_stat:
+            if expected_size and file_stat.st_size >= expected_size:
+                print(f"    File already complete: {os.path.basename(filepath)}")
+                return True
+            
+            # Without a size from the database, ask the server for one with a bodiless HEAD
+            # before sending a GET for a file that may already be complete
+            if not expected_size:
+                try:
+                    remote_size = probe_remote(session, url, config['download']['timeout_seconds'], rate_limiter)[0]
+                except requests.exceptions.RequestException:
+                    # The GET below reports the error if the server is really unreachable
+                    remote_size = None
+                if remote_size == file_stat.st_size:
+                    print(f"    File already complete: {os.path.basename(filepath)}")
+                    return True
+            
+            # Left partial under the real name by an older version of this script; resume it as the .part
+            os.replace(filepath, part_path)
         
-        total_size = int(response.headers.get('content-length', 0)) + resume_pos
+        # Resume from the bytes an earlier run left in the .part file
+        part_stat = stat_or_none(part_path)
+        resume_pos = part_stat.st_size if part_stat else 0
+        if resume_pos:
+            headers['Range'] = f'bytes={resume_pos}-'
         
-        with open(filepath, mode) as f:
-            downloaded = resume_pos
-            last_progress_mb = downloaded // (1024 * 1024)
+        if rate_limiter:
+            rate_limiter.acquire()
+        with session.get(url, headers=headers, stream=True, timeout=config['download']['timeout_seconds']) as response:
+            # Handle range request responses
+            if response.status_code == 206:  # Partial content
+                mode = 'ab'
+            elif response.status_code == 200:  # Full content
+                mode = 'wb'
+                resume_pos = 0
+            elif response.status_code == 416 and resume_pos:
+                # The .part is as long as the server copy: preallocated by a run that was killed, so start over
+                print(f"    Partial file is not resumable, restarting: {os.path.basename(filepath)}")
+                os.remove(part_path)
+                return download_file(url, filepath, expected_size, config, session, rate_limiter)
+            else:
+                response.raise_for_status()
+            
+            total_size = int(response.headers.get('content-length', 0)) + resume_pos
             
-            for chunk in response.iter_content(chunk_size=config['download']['chunk_size_bytes']):
-                if chunk:
-                    f.write(chunk)
-                    downloaded += len(chunk)
-                    
-                    # Progress update every 10MB to reduce spam
-                    current_mb = downloaded // (1024 * 1024)
-                    if current_mb >= last_progress_mb + 10:  # Every 10MB
-                        if total_size > 0:
-                            percent = (downloaded / total_size) * 100
-                            print(f"    Progress: {current_mb}MB / {total_size // (1024*1024)}MB ({percent:.1f}%)")
-                        last_progress_mb = current_mb
+            with open(part_path, mode) as f:
+                writer = ProgressWriter(f, filepath, resume_pos, total_size)
+                if mode == 'wb' and total_size > 0:
+                    preallocate_file(f.fileno(), total_size)
+                
+                save_response_body(response, writer, config['download']['chunk_size_bytes'])
         
-        print(f"    ✓ Downloaded: {os.path.basename(filepath)} ({downloaded // (1024*1024)}MB)")
+        os.replace(part_path, filepath)
+        print(f"    ✓ Downloaded: {os.path.basename(filepath)} ({writer.downloaded // (1024*1024)}MB)")
         return True
         
     except requests.exceptions.RequestException as e:
@@ -179,6 +245,7 @@ def download_file(url, filepath, expected_size=None, config=None):
 def create_download_log_table(conn):
     """Create table to track download progress."""
     cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS download_log (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -196,28 +263,43 @@ def create_download_log_table(conn):
     ''')
     
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_download_log_product ON download_log (product_name)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_download_log_success ON download_log (download_success)')
-    conn.commit()
+    # Covering index for the anti-join in get_shapefiles_to_download; it supersedes the success-only index
+    cursor.execute('DROP INDEX IF EXISTS idx_download_log_success')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_download_log_success_product ON download_log (download_success, product_name)')
+    cursor.execute('COMMIT')
 
-def log_download_result(conn, state_code, county_code, community_code, product_name, 
-                       product_file_path, success, file_path=None, file_size=None, error_msg=None):
-    """Log download result to database."""
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO download_log 
-        (state_code, county_code, community_code, product_name, product_file_path, 
-         download_success, file_path, file_size_bytes, error_message)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (state_code, county_code, community_code, product_name, product_file_path,
-          success, file_path, file_size, error_msg))
-    conn.commit()
+def create_shapefile_indexes(conn):
+    """Create the shapefiles indexes used to select the files to download."""
+    for index_name, index_target in SHAPEFILE_INDEXES.items():
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {index_target}')
+
+class DownloadLogBuffer(LogBuffer):
+    """Download results queued for download_log."""
+    def __init__(self, conn):
+        super().__init__(conn, INSERT_LOG_SQL)
+    
+    def log_download_result(self, state_code, county_code, community_code, product_name,
+                            product_file_path, success, file_path=None, file_size=None, error_msg=None):
+        """Queue a download result, writing the batch once it reaches flush_size rows."""
+        self.add((state_code, county_code, community_code, product_name, product_file_path,
+                  success, file_path, file_size, error_msg))
 
-def get_downloaded_files(conn):
-    """Get set of already successfully downloaded files."""
+def get_file_counts(conn):
+    """Count the shapefiles in the database and how many of them were already downloaded successfully."""
     cursor = conn.cursor()
-    cursor.execute('SELECT product_name FROM download_log WHERE download_success = 1')
-    return set(row[0] for row in cursor.fetchall())
+    cursor.execute('''
+        SELECT COUNT(DISTINCT sf.product_name), COUNT(DISTINCT dl.product_name)
+        FROM shapefiles sf
+        JOIN states s ON sf.state_code = s.state_code
+        JOIN counties c ON sf.county_code = c.county_code
+        JOIN communities cm ON sf.community_code = cm.community_code
+        LEFT JOIN download_log dl ON dl.product_name = sf.product_name AND dl.download_success = 1
+        WHERE sf.product_file_path IS NOT NULL
+    ''')
+    return cursor.fetchone()
 
+# Sizes repeat across products ('1MB', '2MB', ...), so each distinct string is parsed once
+@functools.lru_cache(maxsize=1024)
 def parse_file_size(size_str):
     """Parse file size string like '248MB' to bytes."""
     if not size_str:
@@ -236,6 +318,26 @@ def parse_file_size(size_str):
         except:
             return None
 
+def download_shapefile(shapefile, download_url, expected_size, download_base_path, config, session, rate_limiter):
+    """Download one shapefile; runs in a worker thread and returns (filepath, success, actual_size)."""
+    (state_code, county_code, community_code, product_name, 
+     product_file_path, product_file_size, state_name, county_name, community_name) = shapefile
+    
+    # The county folder was created by main before this file was queued
+    download_folder = os.path.join(download_base_path, state_code, county_code)
+    
+    # Determine filename
+    filename = f"{product_name}.zip"
+    filepath = os.path.join(download_folder, filename)
+    
+    # Download file
+    success = download_file(download_url, filepath, expected_size, config, session, rate_limiter)
+    
+    # Get actual file size
+    file_stat = stat_or_none(filepath) if success else None
+    actual_size = file_stat.st_size if file_stat else 0
+    return filepath, success, actual_size
+
 def main():
     """Main function to download all shapefiles."""
     # Parse command line arguments
@@ -270,14 +372,15 @@ def main():
     try:
         conn = connect_database(db_path)
         create_download_log_table(conn)
+        create_shapefile_indexes(conn)
     except FileNotFoundError as e:
         print(f"Error: {e}")
         print("Please run 04_get_flood_risk_shapefiles.py first to create the database.")
         return
     
-    # Get shapefiles to download
-    shapefiles = get_shapefiles_to_download(conn)
-    total_files = len(shapefiles)
+    # Get shapefiles to download; already downloaded files are filtered out by the query
+    files_to_download = get_shapefiles_to_download(conn, args.limit)
+    total_files, downloaded_files_count = get_file_counts(conn)
     
     if total_files == 0:
         print("No shapefiles found in database.")
@@ -287,96 +390,100 @@ def main():
     print(f"Download location: {download_base_path}")
     print("=" * 60)
     
-    # Get already downloaded files
-    downloaded_files = get_downloaded_files(conn)
+    print(f"Files already downloaded: {downloaded_files_count}")
+    remaining_files = total_files - downloaded_files_count
+    print(f"Files remaining to download: {remaining_files}")
     
-    # Filter out already downloaded files
-    files_to_download = []
-    for shapefile in shapefiles:
-        product_name = shapefile[3]  # product_name is at index 3
-        if product_name not in downloaded_files:
-            files_to_download.append(shapefile)
-    
-    print(f"Files already downloaded: {len(downloaded_files)}")
-    print(f"Files remaining to download: {len(files_to_download)}")
-    
-    # Apply limit if specified
-    if args.limit and len(files_to_download) > args.limit:
-        files_to_download = files_to_download[:args.limit]
+    if args.limit:
         print(f"Limited to first {args.limit} files for testing")
+        remaining_files = min(remaining_files, args.limit)
     
-    print(f"Will download {len(files_to_download)} files")
+    print(f"Will download {remaining_files} files")
     print("=" * 60)
     
     # Create base download directory
     os.makedirs(download_base_path, exist_ok=True)
     
     # Download statistics
+    processed_count = 0
     downloaded_count = 0
     failed_count = 0
     skipped_count = 0
     total_size_downloaded = 0
     
-    # Process each shapefile
-    for i, shapefile in enumerate(files_to_download, 1):
-        (state_code, county_code, community_code, product_name, 
-         product_file_path, product_file_size, state_name, county_name, community_name) = shapefile
-        
-        print(f"\n[{i}/{len(files_to_download)}] Processing: {product_name}")
-        print(f"  State: {state_name} ({state_code})")
-        print(f"  County: {county_name} ({county_code})")
-        print(f"  Community: {community_name} ({community_code})")
-        print(f"  Size: {product_file_size}")
-        
-        # Create download folder
-        download_folder = create_download_folder(download_base_path, state_code, county_code)
-        
-        # Determine filename
-        filename = f"{product_name}.zip"
-        filepath = os.path.join(download_folder, filename)
-        
-        # Get download URL
-        download_url = get_download_url(product_name)
-        print(f"  URL: {download_url}")
-        
-        # Parse expected file size
-        expected_size = parse_file_size(product_file_size)
-        
-        # Download file
-        success = download_file(download_url, filepath, expected_size, config)
-        
-        if success:
-            # Get actual file size
-            actual_size = os.path.getsize(filepath) if os.path.exists(filepath) else 0
-            total_size_downloaded += actual_size
-            downloaded_count += 1
+    max_workers = get_max_workers(config)
+    print(f"Downloading with {max_workers} parallel workers")
+    
+    session = create_session({'User-Agent': config['api']['user_agent']}, max_workers)
+    rate_limiter = create_rate_limiter(config)
+    
+    # Workers only download; every result is logged from this thread
+    default_stack_size = threading.stack_size(WORKER_STACK_SIZE)
+    try:
+        with DownloadLogBuffer(conn) as log_buffer, ThreadPoolExecutor(max_workers=max_workers) as executor:
+            county_folders = set()
             
-            # Log success
-            log_download_result(conn, state_code, county_code, community_code,
-                              product_name, product_file_path, True, filepath, actual_size)
-        else:
-            failed_count += 1
-            # Log failure
-            log_download_result(conn, state_code, county_code, community_code,
-                              product_name, product_file_path, False, error_msg="Download failed")
-        
-        # Progress summary
-        if i % 10 == 0 or i == len(files_to_download):
-            print(f"\n  Progress Summary: {i}/{len(files_to_download)} processed")
-            print(f"    Downloaded: {downloaded_count}")
-            print(f"    Failed: {failed_count}")
-            print(f"    Total size: {total_size_downloaded // (1024*1024)}MB")
-        
-        # Rate limiting
-        time.sleep(config['download']['rate_limit_seconds'])
+            def queue_download(shapefile):
+                (state_code, county_code, community_code, product_name, 
+                 product_file_path, product_file_size, state_name, county_name, community_name) = shapefile
+                
+                # Each county folder is created once per run, not once per file
+                if (state_code, county_code) not in county_folders:
+                    create_download_folder(download_base_path, state_code, county_code)
+                    county_folders.add((state_code, county_code))
+                
+                print(f"\nQueued: {product_name}")
+                print(f"  State: {state_name} ({state_code})")
+                print(f"  County: {county_name} ({county_code})")
+                print(f"  Community: {community_name} ({community_code})")
+                print(f"  Size: {product_file_size}")
+                # URL and expected size are worked out once here, not again in the worker
+                download_url = get_download_url(product_name)
+                expected_size = parse_file_size(product_file_size)
+                print(f"  URL: {download_url}")
+                
+                return executor.submit(download_shapefile, shapefile, download_url, expected_size,
+                                       download_base_path, config, session, rate_limiter)
+            
+            completed = submit_bounded(queue_download, files_to_download,
+                                       max_workers * PENDING_DOWNLOADS_PER_WORKER)
+            for shapefile, future in completed:
+                (state_code, county_code, community_code, product_name, 
+                 product_file_path, product_file_size, state_name, county_name, community_name) = shapefile
+                filepath, success, actual_size = future.result()
+                processed_count += 1
+            
+                if success:
+                    total_size_downloaded += actual_size
+                    downloaded_count += 1
+                
+                    # Log success
+                    log_buffer.log_download_result(state_code, county_code, community_code,
+                                                   product_name, product_file_path, True, filepath, actual_size)
+                else:
+                    failed_count += 1
+                    # Log failure
+                    log_buffer.log_download_result(state_code, county_code, community_code,
+                                                   product_name, product_file_path, False,
+                                                   error_msg="Download failed")
+            
+                # Progress summary
+                if processed_count % 10 == 0 or processed_count == remaining_files:
+                    print(f"\n  Progress Summary: {processed_count}/{remaining_files} processed")
+                    print(f"    Downloaded: {downloaded_count}")
+                    print(f"    Failed: {failed_count}")
+                    print(f"    Total size: {total_size_downloaded // (1024*1024)}MB")
+    finally:
+        session.close()
+        threading.stack_size(default_stack_size)
     
     # Final summary
     print("\n" + "=" * 60)
     print("DOWNLOAD PROCESS COMPLETE")
     print("=" * 60)
     print(f"Total files in database: {total_files}")
-    print(f"Files already downloaded: {len(downloaded_files)}")
-    print(f"Files processed this run: {len(files_to_download)}")
+    print(f"Files already downloaded: {downloaded_files_count}")
+    print(f"Files processed this run: {processed_count}")
     print(f"Successfully downloaded: {downloaded_count}")
     print(f"Failed downloads: {failed_count}")
     print(f"Total data downloaded: {total_size_downloaded // (1024*1024)}MB")
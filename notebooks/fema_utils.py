@@ -0,0 +1,494 @@
+"""
+Helpers shared by the FEMA fetch and download scripts.
+
+The HTTP session, rate limiting and SQLite WAL setup are used by every script.
+Fetch retries, JSON parsing and output, and the result writer thread serve the
+metadata fetch scripts (02-04); the download settings, log buffering, HEAD probe,
+bounded submission and file-writing helpers the download scripts (05).
+"""
+
+import json
+import logging
+import os
+import queue
+import shutil
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, as_completed, wait
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# orjson parses and serializes much faster; the stdlib json module is the fallback
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Parses bytes or str. orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers
+# catch the stdlib exception whichever parser is in use
+json_loads = orjson.loads if orjson is not None else json.loads
+
+logger = logging.getLogger(__name__)
+
+# Separate connect/read timeouts for the FEMA portal's metadata requests
+REQUEST_TIMEOUT = (5, 30)
+
+# Times a failed fetch is submitted in total before it is given up for this run
+MAX_FETCH_ATTEMPTS = 3
+
+# Headers the portal's advanced search expects, as sent by its own search page
+PORTAL_SEARCH_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Content-Type': 'application/x-www-form-urlencoded',
+    'Accept': 'application/json, text/javascript, */*; q=0.01',
+    'X-Requested-With': 'XMLHttpRequest'
+}
+
+# Defaults for the parallel download settings when the config file predates them
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_MAX_WORKERS_CAP = 16
+
+# Download workers only run requests and file copies, which need a fraction of the
+# platform default stack (1MB on Windows, 8MB on Linux)
+WORKER_STACK_SIZE = 512 * 1024
+
+# Files queued per worker ahead of the downloads in progress; rows are read from the database
+# only as downloads finish, not all up front
+PENDING_DOWNLOADS_PER_WORKER = 2
+
+# Download results written to the log per transaction
+LOG_FLUSH_SIZE = 50
+
+class FetchError(Exception):
+    """
+    Raised when a request failed or its response cannot be used, as opposed to having no results
+    """
+
+class RateLimiter:
+    """
+    Thread-safe token bucket limiting how many requests start per second
+    """
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available, then consume it
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+def get_max_workers(config: Dict[str, Any]) -> int:
+    """
+    Read the number of parallel downloads from the config, limited to download.max_workers_cap
+    """
+    max_workers = config['download'].get('max_workers', DEFAULT_MAX_WORKERS)
+    max_workers_cap = config['download'].get('max_workers_cap', DEFAULT_MAX_WORKERS_CAP)
+    if max_workers > max_workers_cap:
+        print(f"Warning: download.max_workers={max_workers} exceeds download.max_workers_cap={max_workers_cap}; "
+              f"using {max_workers_cap}")
+        return max_workers_cap
+    return max(1, max_workers)
+
+def get_requests_per_second(config: Dict[str, Any]) -> float:
+    """
+    Read the global request rate from the config; configs without it fall back to 1 / rate_limit_seconds
+    """
+    requests_per_second = config['download'].get('requests_per_second')
+    if requests_per_second is None:
+        rate_limit_seconds = config['download'].get('rate_limit_seconds', 0)
+        requests_per_second = 1 / rate_limit_seconds if rate_limit_seconds > 0 else 0
+    return requests_per_second
+
+def create_rate_limiter(config: Dict[str, Any]) -> Optional[RateLimiter]:
+    """
+    Create the limiter shared by all download workers, so they draw on one rate budget
+    however many run at once
+
+    Returns:
+        The limiter, or None when the config sets no rate
+    """
+    requests_per_second = get_requests_per_second(config)
+    return RateLimiter(requests_per_second) if requests_per_second > 0 else None
+
+def loads_json_object(content) -> Dict[str, Any]:
+    """
+    Parse a JSON response body that has to be an object
+
+    Args:
+        content: Response body, as bytes or str
+
+    Returns:
+        The parsed object
+
+    Raises:
+        ValueError: The body is not JSON (json.JSONDecodeError), or is JSON but not an
+            object, e.g. a list or null
+    """
+    data = json_loads(content)
+    if not isinstance(data, dict):
+        raise ValueError(f"Expected a JSON object, got {type(data).__name__}")
+    return data
+
+def write_json_file(data: Any, file_path: str, pretty: bool = True):
+    """
+    Write data as JSON, using orjson when it is installed
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if pretty else 0)
+        with open(file_path, 'wb', buffering=1 << 20) as json_file:
+            json_file.write(orjson.dumps(data, option=option))
+    else:
+        with open(file_path, 'w', encoding='utf-8', buffering=1 << 20) as json_file:
+            json.dump(data, json_file, indent=2 if pretty else None, ensure_ascii=False)
+
+def create_session(headers: Dict[str, str], pool_size: int = 1, retries: int = 3,
+                   retry_statuses: Iterable[int] = (502, 503, 504),
+                   retry_methods: Optional[Iterable[str]] = None,
+                   backoff_factor: float = 0.5, pool_block: bool = False) -> requests.Session:
+    """
+    Create a session shared by all workers, so TCP/TLS connections to the FEMA portal stay alive
+
+    Retries honour Retry-After, so a 429 waits as long as the server asks.
+
+    Args:
+        headers: Headers sent with every request, including the User-Agent
+        pool_size: Connections kept open, i.e. the number of workers sharing the session
+        retries: Attempts made for connection errors and retry_statuses responses
+        retry_statuses: Status codes retried by the adapter
+        retry_methods: Methods retried; None keeps urllib3's idempotent defaults, which exclude POST
+        backoff_factor: Base of the exponential wait between retries, in seconds
+        pool_block: Make workers wait for a pooled connection instead of opening extra ones
+            that are discarded afterwards
+
+    Returns:
+        Configured requests session
+    """
+    session = requests.Session()
+    session.headers.update(headers)
+    method_options = {} if retry_methods is None else {'allowed_methods': frozenset(retry_methods)}
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=pool_size,
+        pool_block=pool_block,
+        max_retries=Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=list(retry_statuses),
+                          respect_retry_after_header=True, **method_options)
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def fetch_with_requeue(submit: Callable[[Any], Future], items: Iterable[Any],
+                       max_attempts: int = MAX_FETCH_ATTEMPTS) -> Iterator[Tuple[Any, Any]]:
+    """
+    Submit every item and yield its result as it completes, re-queueing failed fetches
+
+    A FetchError is not an empty result, so the item is submitted again, after the
+    rest of the current round, until it has been tried max_attempts times. Retries
+    and failures are logged as warnings and errors.
+
+    Args:
+        submit: Callable queueing one item's fetch on an executor and returning its future
+        items: Items to fetch
+        max_attempts: Times an item is submitted in total before it is given up
+
+    Yields:
+        (item, result) pairs in completion order; result is None for an item given up on
+    """
+    futures: Dict[Future, Tuple[Any, int]] = {submit(item): (item, 1) for item in items}
+    while futures:
+        retry_futures: Dict[Future, Tuple[Any, int]] = {}
+        for future in as_completed(futures):
+            item, attempt = futures[future]
+            try:
+                result = future.result()
+            except FetchError as e:
+                if attempt < max_attempts:
+                    logger.warning(f"{e} (re-queued, attempt {attempt + 1}/{max_attempts})")
+                    retry_futures[submit(item)] = (item, attempt + 1)
+                    continue
+                logger.error(f"{e} (giving up after {attempt} attempts)")
+                result = None
+            yield item, result
+        futures = retry_futures
+
+def enable_wal(conn: sqlite3.Connection):
+    """
+    Put the database in WAL mode with synchronous=NORMAL
+
+    Commits then append to the log without an fsync each, and readers never block the writer.
+    """
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+
+class LogBuffer:
+    """
+    Collect log rows and write them to the database in batches
+
+    Used as a context manager, it writes the rows still queued on exit, so results
+    are kept even if the run is interrupted.
+
+    Args:
+        conn: Connection in autocommit mode; each batch is written in its own transaction
+        insert_sql: INSERT statement taking one queued row as its parameters
+        flush_size: Rows queued before they are written
+    """
+    def __init__(self, conn: sqlite3.Connection, insert_sql: str, flush_size: int = LOG_FLUSH_SIZE):
+        self.conn = conn
+        self.insert_sql = insert_sql
+        self.flush_size = flush_size
+        self.rows = []
+
+    def add(self, row: Tuple):
+        """
+        Queue a row, writing the batch once it reaches flush_size rows
+        """
+        self.rows.append(row)
+        if len(self.rows) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all queued rows in a single transaction
+        """
+        if not self.rows:
+            return
+        cursor = self.conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.executemany(self.insert_sql, self.rows)
+        cursor.execute('COMMIT')
+        self.rows.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+def probe_remote(session: requests.Session, url: str, timeout: float,
+                 rate_limiter: Optional[RateLimiter] = None) -> Tuple[Optional[int], Optional[str], Optional[str], bool]:
+    """
+    Ask the server about a file with a bodiless HEAD request
+
+    Args:
+        session: Session to send the request with
+        url: File URL; redirects are followed
+        timeout: Request timeout in seconds
+        rate_limiter: Limiter the request counts against, if any
+
+    Returns:
+        (size, etag, last_modified, accepts_ranges) as reported by the server
+
+    Raises:
+        requests.exceptions.RequestException: The request failed or returned an error status
+    """
+    if rate_limiter:
+        rate_limiter.acquire()
+    response = session.head(url, allow_redirects=True, timeout=timeout)
+    response.close()
+    response.raise_for_status()
+    content_length = response.headers.get('Content-Length')
+    return (int(content_length) if content_length else None,
+            response.headers.get('ETag'),
+            response.headers.get('Last-Modified'),
+            response.headers.get('Accept-Ranges', '').lower() == 'bytes')
+
+def preallocate_file(fd: int, size: int):
+    """
+    Reserve size bytes for the open file so it is allocated in one go rather than grown per write
+    """
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # Not available on Windows and rejected by some filesystems; the file then grows as written
+        pass
+
+def drop_page_cache(fd: int):
+    """
+    Tell the kernel the file's cached pages will not be read again soon
+    """
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except (AttributeError, OSError):
+        pass
+
+class ProgressWriter:
+    """
+    File wrapper that counts written bytes and prints progress every 10MB
+
+    If write_slots is given, each write holds one of its slots, bounding how many
+    downloads write to disk at the same time. Threads fetching byte ranges of one
+    file share a single writer through write_to(), each with its own handle on the
+    file, so the file's progress is reported as a whole.
+    """
+    def __init__(self, f, filepath: str, downloaded: int, total_size: int, write_slots=None):
+        self.f = f
+        self.write_slots = write_slots or nullcontext()
+        self.name = os.path.basename(filepath)
+        self.downloaded = downloaded
+        self.total_size = total_size
+        self.last_progress_mb = downloaded // (1024 * 1024)
+        self.lock = threading.Lock()
+
+    def write(self, data: bytes):
+        self.write_to(self.f, data)
+
+    def write_to(self, f, data: bytes):
+        """
+        Write data to f, any handle on the file being downloaded, and count it towards the progress
+        """
+        # Only the write waits for a slot; the other workers keep receiving from the network meanwhile
+        with self.write_slots:
+            f.write(data)
+
+        with self.lock:
+            self.downloaded += len(data)
+
+            # Progress update every 10MB to reduce spam; named, since downloads run in parallel
+            current_mb = self.downloaded // (1024 * 1024)
+            if current_mb >= self.last_progress_mb + 10:
+                if self.total_size > 0:
+                    percent = (self.downloaded / self.total_size) * 100
+                    print(f"    Progress {self.name}: "
+                          f"{current_mb}MB / {self.total_size // (1024*1024)}MB ({percent:.1f}%)")
+                self.last_progress_mb = current_mb
+
+def save_response_body(response: requests.Response, writer: ProgressWriter, chunk_size: int):
+    """
+    Copy a streamed response into the file behind writer, leaving the file as long as the bytes received
+
+    The file is trimmed even when the copy fails part way, so space preallocated past the
+    received bytes never looks like downloaded data to a later resume. Its pages are then
+    dropped from the page cache, as nothing reads the file back.
+    """
+    f = writer.f
+    try:
+        # Copy straight from the socket in large blocks instead of iterating chunks in Python
+        response.raw.decode_content = True
+        shutil.copyfileobj(response.raw, writer, chunk_size)
+    finally:
+        f.truncate(writer.downloaded)
+        f.flush()
+        drop_page_cache(f.fileno())
+
+def submit_bounded(submit: Callable[[Any], Future], items: Iterable[Any],
+                   max_pending: int) -> Iterator[Tuple[Any, Future]]:
+    """
+    Submit items with at most max_pending unfinished at a time, yielding each as it completes
+
+    items is only read as futures finish, so a streamed cursor is never drained into
+    the executor's queue ahead of the downloads.
+
+    Args:
+        submit: Callable queueing one item on an executor and returning its future
+        items: Items to submit, consumed lazily
+        max_pending: Most futures submitted but not yet yielded
+
+    Yields:
+        (item, future) pairs in completion order
+    """
+    pending: Dict[Future, Any] = {}
+    for item in items:
+        while len(pending) >= max_pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future
+        pending[submit(item)] = item
+
+    for future in as_completed(pending):
+        yield pending[future], future
+
+
+class ResultWriter(threading.Thread):
+    """
+    Thread draining fetched results into SQLite, so commits never hold up the fetch loop
+
+    It opens its own connection and is the only thread writing through it. Subclasses
+    implement write() and flush(). If writing fails, the error is kept in self.error
+    and the thread stops; put() then raises instead of queueing results nobody will
+    write, and the caller re-raises self.error once close() returns.
+
+    Args:
+        connect: Callable opening the writer's connection; called in the writer thread
+        maxsize: Most results waiting to be written; put() blocks while the queue is full
+    """
+    def __init__(self, connect: Callable[[], sqlite3.Connection], maxsize: int = 0):
+        super().__init__()
+        self.connect = connect
+        self.queue: queue.Queue = queue.Queue(maxsize)
+        self.error = None
+
+    def write(self, conn: sqlite3.Connection, item: Any):
+        """
+        Store one queued result; may leave it buffered or uncommitted until flush()
+        """
+        raise NotImplementedError
+
+    def flush(self, conn: sqlite3.Connection):
+        """
+        Write and commit whatever write() left pending; called once all results are queued
+        """
+        raise NotImplementedError
+
+    def run(self):
+        conn = None
+        try:
+            conn = self.connect()
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                self.write(conn, item)
+
+            self.flush(conn)
+        except BaseException as e:
+            # Nothing is committed after a failure; uncommitted rows roll back on close
+            self.error = e
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def put(self, item: Any):
+        """
+        Queue a result for writing, waiting while the queue is full
+
+        Raises:
+            RuntimeError: The writer has stopped, so the result could never be written
+        """
+        while True:
+            if not self.is_alive():
+                raise RuntimeError("Result writer stopped; results can no longer be saved") from self.error
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def close(self):
+        """
+        Ask the writer to store everything queued so far and wait for it to finish
+        """
+        while self.is_alive():
+            try:
+                self.queue.put(None, timeout=1)
+                break
+            except queue.Full:
+                pass
+        self.join()
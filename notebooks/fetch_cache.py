@@ -0,0 +1,78 @@
+"""
+SQLite checkpoint store for FEMA API responses.
+
+Each successful API call is stored as a raw JSON payload keyed by
+"<endpoint>:<param>" (for example "county:01"). Fetch scripts look the key up
+before hitting the network, so a run that was interrupted can be restarted and
+will only request the entries that are still missing.
+
+Failed fetches are never stored: the fetcher callable must raise on error.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Optional
+
+CACHE_DB_PATH = os.path.join('..', 'meta_results', 'fetch_cache.db')
+
+# sqlite3 connections cannot be shared between threads, so each worker gets its own
+_thread_local = threading.local()
+
+def get_connection(db_path: str = CACHE_DB_PATH) -> sqlite3.Connection:
+    """
+    Return this thread's connection to the cache database, creating it if needed
+    """
+    connections = getattr(_thread_local, 'connections', None)
+    if connections is None:
+        connections = _thread_local.connections = {}
+
+    conn = connections.get(db_path)
+    if conn is None:
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        conn = sqlite3.connect(db_path, timeout=30)
+
+        # WAL lets concurrent workers read while another one writes
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS fetch_cache (
+                key TEXT PRIMARY KEY,
+                payload BLOB NOT NULL,
+                ts INTEGER NOT NULL
+            )
+        ''')
+        conn.commit()
+        connections[db_path] = conn
+
+    return conn
+
+def get_or_fetch(key: str, fetcher: Callable[[], Any], db_path: str = CACHE_DB_PATH,
+                 max_age: Optional[float] = None) -> Any:
+    """
+    Return the cached payload for key, or call fetcher and cache its result
+
+    Args:
+        key: Cache key in the form "<endpoint>:<param>"
+        fetcher: Callable performing the API request; must raise on failure
+        db_path: Path to the cache database
+        max_age: Seconds a cached payload stays valid; None keeps it forever
+
+    Returns:
+        Decoded JSON payload
+    """
+    conn = get_connection(db_path)
+    oldest_ts = 0 if max_age is None else time.time() - max_age
+    row = conn.execute('SELECT payload FROM fetch_cache WHERE key = ? AND ts >= ?', (key, oldest_ts)).fetchone()
+    if row:
+        return json.loads(row[0])
+
+    data = fetcher()
+    conn.execute(
+        'INSERT OR REPLACE INTO fetch_cache (key, payload, ts) VALUES (?, ?, ?)',
+        (key, json.dumps(data, ensure_ascii=False), int(time.time()))
+    )
+    conn.commit()
+    return data